@@ -0,0 +1,54 @@
+import pandas as pd
+import numpy as np
+from datetime import datetime
+
+# note: times are carried through ingest, the trajectory outputs and matching as integer epoch milliseconds,
+#  the representation of the raw timestamp column. naive datetimes (older csv outputs, datetime objects)
+#  are local times, the way the raw timestamps were converted with datetime.fromtimestamp.
+HOUR_MS = 3600 * 1000
+# note: pandas 2 parses a column with one format guessed from its first value, mixed ISO 8601 strings
+#  (with and without fractions or offsets) need format='ISO8601' there. older pandas (the pinned 1.1.3)
+#  has no such format and already parses every value on its own.
+ISO8601_FORMAT = dict(format='ISO8601') if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+
+def local_offsets(epoch_ms):
+    # note: utc offset (ms) of the local time zone at each epoch time. offsets are looked up once per
+    #  distinct hour, not per value.
+    hours, inverse = np.unique(np.asarray(epoch_ms, dtype=np.int64) // HOUR_MS, return_inverse=True)
+    offsets = np.array([
+        datetime.fromtimestamp(hour * 3600).astimezone().utcoffset().total_seconds() * 1000 for hour in hours
+    ], dtype=np.int64)
+    return offsets[inverse].reshape(np.shape(epoch_ms))
+
+
+def to_epoch_ms(values):
+    # note: converts a column of epoch milliseconds (numbers or numeric strings), datetime64 values,
+    #  datetime objects or datetime strings to an int64 array of epoch milliseconds
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy().astype(np.int64)
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        numbers = pd.to_numeric(values, errors='coerce')
+        if numbers.notna().all():
+            return numbers.to_numpy().astype(np.int64)
+        values = pd.to_datetime(values, **ISO8601_FORMAT)
+    if values.dt.tz is not None:
+        return values.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().astype('datetime64[ms]').astype(np.int64)
+    wall_ms = values.to_numpy().astype('datetime64[ms]').astype(np.int64)
+    epoch_ms = wall_ms - local_offsets(wall_ms)
+    return wall_ms - local_offsets(epoch_ms)
+
+
+def epoch_to_datetime(epoch_ms):
+    # note: local naive datetime64 values of epoch milliseconds, for printing and plotting only
+    epoch_ms = np.asarray(epoch_ms, dtype=np.int64)
+    return (epoch_ms + local_offsets(epoch_ms)).astype('datetime64[ms]')
+
+
+def elapsed_seconds(times, previous_times):
+    # note: whole seconds between epoch millisecond times, element-wise. unlike timedelta.seconds the
+    #  whole days are kept.
+    return (np.asarray(times, dtype=np.int64) - np.asarray(previous_times, dtype=np.int64)) // 1000
@@ -10,40 +10,67 @@ from haversine import haversine, Unit
 import glob
 import os
 
-def traj_partition(dirpath, boundary, output_dirpath, split_threshold):
+def tile_dirname(boundary):
+    return f'{str(boundary["west"]).index(".")}{str(boundary["west"]).replace(".", "")}-' + \
+           f'{str(boundary["west"]).index(".")}{str(boundary["east"]).replace(".", "")}-' + \
+           f'{str(boundary["west"]).index(".")}{str(boundary["south"]).replace(".", "")}-' + \
+           f'{str(boundary["west"]).index(".")}{str(boundary["north"]).replace(".", "")}'
+
+
+def write_tile_chunks(tile, split_threshold, final=False):
+    # note: writes the buffered points of a tile in chunks of at least split_threshold points. a chunk is
+    #  extended to the end of its last route, when that route may continue in the next file the points stay
+    #  in the buffer until more data arrives or the final flush.
+    while tile['n_buffered'] >= split_threshold or (final and tile['n_buffered'] > 0):
+        buffered_df = pd.concat(tile['buffer'], ignore_index=True)
+        route_ids = buffered_df.route_id.to_numpy()
+        end_idx = min(split_threshold, len(buffered_df)) - 1
+        route_changes = np.flatnonzero(route_ids[end_idx + 1:] != route_ids[end_idx:-1])
+        if route_changes.size:
+            end_idx += route_changes[0]
+        elif final:
+            end_idx = len(buffered_df) - 1
+        else:
+            tile['buffer'] = [buffered_df]
+            break
+        file_name = os.path.join(tile['output_dir'], f'{tile["start_idx"]}-{tile["start_idx"] + end_idx}.csv')
+        buffered_df.iloc[:end_idx + 1].to_csv(file_name, sep=',', header=True, index=False)
+        tile['start_idx'] += end_idx + 1
+        tile['buffer'] = [buffered_df.iloc[end_idx + 1:]]
+        tile['n_buffered'] = len(buffered_df) - end_idx - 1
+
+
+def traj_partition_tiles(dirpath, boundaries, output_dirpath, split_threshold, margin=0):
+    # note: partitions the trajectories of all the tiles in one pass over the csv files. every file is read
+    #  once and its points are appended to the buffer of each tile (extended by margin degrees on every side)
+    #  they fall in, so with a margin the points near tile borders are written to all the neighbour tiles.
     all_files = sorted(glob.glob(os.path.join(dirpath, "*.csv")))
-    each_file_df = (pd.read_csv(f) for f in all_files)
-    all_trajs = pd.concat(each_file_df, ignore_index=True)
-
-    all_trajs = all_trajs[
-        all_trajs.longitude.between(boundary['west'], boundary['east'], inclusive=True) & \
-        all_trajs.latitude.between(boundary['south'], boundary['north'], inclusive=True)
-        ]
-
-    all_trajs.reset_index(drop=True, inplace=True)
-
-    output_dir = f'{str(boundary["west"]).index(".")}{str(boundary["west"]).replace(".", "")}-' + \
-                 f'{str(boundary["west"]).index(".")}{str(boundary["east"]).replace(".", "")}-' + \
-                 f'{str(boundary["west"]).index(".")}{str(boundary["south"]).replace(".", "")}-' + \
-                 f'{str(boundary["west"]).index(".")}{str(boundary["north"]).replace(".", "")}'
-
-
-    output_dir = os.path.join(output_dirpath+output_dir, 'sample-area')
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    split_parts = int(len(all_trajs) / min(split_threshold, len(all_trajs)))
-    idxs = np.array_split(all_trajs, split_parts)
-    start_idx = 0
-    for df in idxs:
-        end_idx = min(df.index[-1], len(all_trajs) - 2)
-        while all_trajs.iloc[end_idx].route_id == all_trajs.iloc[end_idx + 1].route_id:
-            end_idx += 1
-            if end_idx + 1 == len(all_trajs):
-                break
-        file_name = os.path.join(output_dir, f'{start_idx}-{end_idx}.csv')
-        chunk_df = all_trajs.iloc[start_idx:end_idx + 1]
-        chunk_df.to_csv(file_name, sep=',', header=True, index=False)
-        start_idx = end_idx + 1
-
-    return output_dir
\ No newline at end of file
+    tiles = []
+    for boundary in boundaries:
+        output_dir = os.path.join(output_dirpath + tile_dirname(boundary), 'sample-area')
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        tiles.append(dict(boundary=boundary, output_dir=output_dir, buffer=[], n_buffered=0, start_idx=0))
+
+    for file_path in all_files:
+        trajs = pd.read_csv(file_path)
+        longitudes = trajs.longitude.to_numpy()
+        latitudes = trajs.latitude.to_numpy()
+        for tile in tiles:
+            boundary = tile['boundary']
+            in_tile = (longitudes >= boundary['west'] - margin) & (longitudes <= boundary['east'] + margin) & \
+                      (latitudes >= boundary['south'] - margin) & (latitudes <= boundary['north'] + margin)
+            n_points = int(in_tile.sum())
+            if n_points == 0:
+                continue
+            tile['buffer'].append(trajs[in_tile])
+            tile['n_buffered'] += n_points
+            write_tile_chunks(tile, split_threshold)
+
+    for tile in tiles:
+        write_tile_chunks(tile, split_threshold, final=True)
+    return [tile['output_dir'] for tile in tiles]
+
+
+def traj_partition(dirpath, boundary, output_dirpath, split_threshold, margin=0):
+    return traj_partition_tiles(dirpath, [boundary], output_dirpath, split_threshold, margin)[0]
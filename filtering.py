@@ -1,20 +1,59 @@
 import pandas as pd
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+import pyarrow.parquet as pq
 from shapely import wkb
 from shapely.geometry import LineString
 import geopandas as gp
 from tqdm import tqdm
 import glob
 import sqlite3
-from datetime import datetime
-from itertools import tee
+from datetime import datetime, timedelta
+from itertools import tee, count, repeat, islice
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import os, csv
+import os, hashlib, json, shutil, tempfile, time
 from haversine import haversine, Unit
+from epoch_time import to_epoch_ms, elapsed_seconds
+from quantile_sketch import QuantileSketch
+from traj_store import write_trajectories, route_offsets, encode_linestrings, is_store, store_files, read_points, \
+    TrajectoryBatch, release_shared
 
 # METERS_PER_DEGREE_LATITUDE = 111070.34306591158
 # METERS_PER_DEGREE_LONGITUDE = 83044.98918812413
 EARTH_RADIUS = 6371000 # meters
 
+# note: memory budgeted mode, COMPACT_ROW_BYTES is the size of a compacted record with the temporary
+#  columns of prepare_batch and PEAK_MEMORY_FACTOR covers the copies made while filtering and sorting.
+#  with workers, PARENT_BATCH_COPIES covers the batch the parent is writing (its shared copy and the
+#  frame read back from it)
+CATEGORICAL_COLUMNS = ['device_id', 'route_slug']
+COMPACT_FLOAT_COLUMNS = ['altitude', 'bearing', 'speed']
+COMPACT_ROW_BYTES = 120
+PEAK_MEMORY_FACTOR = 3
+PARENT_BATCH_COPIES = 2
+STAY_MIN_DURATION = 120 # seconds
+DEDUP_WINDOW = 2 # files
+# note: external sort, runs are streamed MERGE_BATCH_ROWS rows at a time, merged frames of whole routes have
+#  at least MERGE_OUTPUT_ROWS rows and at most MERGE_FAN_IN runs are merged at once (more runs are merged
+#  in several passes)
+MERGE_BATCH_ROWS = 100000
+MERGE_OUTPUT_ROWS = 1000000
+MERGE_FAN_IN = 64
+FILTER_STATS_COLUMNS = ['stage', 'threshold', 'points_in', 'points_out', 'trips_in', 'trips_out', 'seconds']
+# note: time (s), distance (m) and speed (m/s) steps between consecutive points of a route are sketched while
+#  loading, each threshold is suggested from a quantile of one of them (min_dist_threshold as the low
+#  quantile used in kde/distribution_plot.py)
+SKETCH_MEASURES = ['delta_time', 'delta_dist', 'avg_speed']
+SUGGESTED_THRESHOLDS = {
+    'min_dist_threshold': ('delta_dist', 0.15),
+    'max_dist_threshold': ('delta_dist', 0.95),
+    'max_time_threshold': ('delta_time', 0.95),
+    'max_spd_threshold': ('avg_speed', 0.95)
+}
+
 
 def pairwise(iterable):
     a, b = tee(iterable)
@@ -27,12 +66,38 @@ def convert_location(x):
     return point.x, point.y
 
 
-def thresh_determiner(obj_list, thresh_percent=0.95, n_bins=100):
-    bin_values, edges = np.histogram(obj_list, bins=n_bins)
-    bin_cum = np.cumsum(bin_values)
-    bin_cum = bin_cum / bin_cum[-1]
-    threshold = int(edges[np.argmin(abs(bin_cum - thresh_percent)) + 1])
-    return threshold
+def decode_locations(locations):
+    # note: decodes a whole column of hex-WKB points in one call into contiguous longitude/latitude
+    #  float arrays. all the rows of a column normally have the same size (21 bytes for a 2D point,
+    #  25 bytes for an EWKB point with srid) and the coordinates are always the last 16 bytes of the row,
+    #  so the column is joined into one buffer and viewed as a 2D byte array. byte order is checked per row.
+    #  columns with mixed or unexpected geometry sizes fall back to convert_location.
+    locations = np.asarray(locations, dtype=object)
+    if len(locations) == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64)
+    is_hex = isinstance(locations[0], str)
+    lengths = np.fromiter((len(x) for x in locations), dtype=np.int64, count=len(locations))
+    row_size = lengths[0] // 2 if is_hex else lengths[0]
+    if lengths.min() != lengths.max() or row_size not in (21, 25):
+        coords = np.array(
+            [convert_location(x) if is_hex else convert_location(bytes(x).hex()) for x in locations],
+            dtype=np.float64
+        )
+        return coords[:, 0].copy(), coords[:, 1].copy()
+    buffer = bytes.fromhex(''.join(locations)) if is_hex else b''.join(locations)
+    raw = np.frombuffer(buffer, dtype=np.uint8).reshape(-1, row_size)
+    coords_bytes = np.ascontiguousarray(raw[:, row_size - 16:])
+    coords = coords_bytes.view('<f8')
+    big_endian = raw[:, 0] == 0
+    if big_endian.any():
+        coords = np.where(big_endian[:, None], coords_bytes.view('>f8'), coords)
+    return coords[:, 0].astype(np.float64), coords[:, 1].astype(np.float64)
+
+
+def thresh_determiner(obj_list, thresh_percent=0.95):
+    # note: thresh_percent quantile of the values from a quantile sketch, see suggest_thresholds for the
+    #  thresholds sketched during loading
+    return int(QuantileSketch().update(obj_list).quantile(thresh_percent))
 
 
 def insert_nodes(node1, node2, n):
@@ -49,151 +114,222 @@ def dist_measure(x, y):
 
 
 def spd_measure(x, y):
-    return dist_measure(x, y)/max((y[3]-x[3]).seconds, 1)
+    times = to_epoch_ms([x[3], y[3]])
+    return dist_measure(x, y)/max(elapsed_seconds(times[1], times[0]), 1)
+
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    # note: same great circle distance as dist_measure (unit: meters) computed on whole coordinate arrays
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype=np.float64)) for x in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def speed_array(distances, seconds):
+    # note: average speed between consecutive points like spd_measure, time steps below 1 second count as 1
+    return np.asarray(distances, dtype=np.float64) / np.maximum(np.asarray(seconds, dtype=np.float64), 1)
+
+
+def trip_steps(trip):
+    # note: distances, time deltas and average speeds between consecutive points of a trip
+    #  (rows of [longitude, latitude, altitude, timestamp, ...]) computed at once
+    longitudes = np.array([point[0] for point in trip], dtype=np.float64)
+    latitudes = np.array([point[1] for point in trip], dtype=np.float64)
+    times = to_epoch_ms([point[3] for point in trip])
+    distances = haversine_array(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    seconds = elapsed_seconds(times[1:], times[:-1])
+    return distances, seconds, speed_array(distances, seconds)
+
+
+def truncate_trip(trip, breaks):
+    # note: keeps the trip up to and including the origin of the first breaking step, a trip with less
+    #  than two points is dropped
+    if len(trip) < 2:
+        return []
+    if breaks.any():
+        return trip[:int(np.argmax(breaks)) + 1]
+    return trip
 
 
 def time_preprocess(trip, time_threshold=20):
-    filtered_trip = []
-    counter = 0
-    for org, dest in pairwise(trip):
-        delta = (dest[3]-org[3]).seconds
-        filtered_trip.append(org)
-        counter += 1
-        if delta > time_threshold:
-            break
-        if counter == len(trip)-1:
-            filtered_trip.append(dest)
-    return filtered_trip
+    if len(trip) < 2:
+        return []
+    _, seconds, _ = trip_steps(trip)
+    return truncate_trip(trip, seconds > time_threshold)
+
+
+def trip_positions(offsets):
+    # note: for trajectories stored back to back with their boundaries in offsets, returns the
+    #  trajectory of each point and the position of each point inside its trajectory
+    lengths = np.diff(offsets)
+    trip_of = np.repeat(np.arange(len(lengths)), lengths)
+    return trip_of, np.arange(offsets[-1]) - offsets[:-1][trip_of]
+
+
+def truncate_arrays(offsets, step_breaks):
+    # note: array version of truncate_trip for a whole batch. step_breaks[k] tells if the step that ends
+    #  at point k breaks its trajectory (ignored for the first point of each trajectory).
+    #  returns the mask of kept points and the new offsets.
+    lengths = np.diff(offsets)
+    trip_of, positions = trip_positions(offsets)
+    step_breaks = step_breaks & (positions > 0)
+    break_points = np.flatnonzero(step_breaks)
+    new_lengths = np.where(lengths < 2, 0, lengths)
+    break_trips, first_breaks = np.unique(trip_of[break_points], return_index=True)
+    new_lengths[break_trips] = positions[break_points[first_breaks]]
+    keep = positions < new_lengths[trip_of]
+    return keep, np.concatenate([[0], np.cumsum(new_lengths)])
+
+
+def merge_arrays(longitudes, latitudes, offsets, max_dist_threshold=170, min_dist_threshold=2):
+    # note: array version of dist_preprocess for a whole batch. every trajectory keeps an anchor point,
+    #  next points closer than min_dist_threshold to the anchor are dropped, a farther point is kept and
+    #  becomes the new anchor and a jump over max_dist_threshold ends the trajectory. the scan is sequential
+    #  inside a trajectory, so all trajectories of the batch are advanced together one candidate per step.
+    lengths = np.diff(offsets)
+    keep = np.zeros(offsets[-1], dtype=bool)
+    anchors = offsets[:-1].copy()
+    candidates = anchors + 1
+    ends = offsets[1:]
+    active = np.flatnonzero(lengths >= 2)
+    while active.size:
+        anchor, candidate = anchors[active], candidates[active]
+        delta = haversine_array(latitudes[anchor], longitudes[anchor], latitudes[candidate], longitudes[candidate])
+        moved = delta >= min_dist_threshold
+        keep[anchor[moved]] = True
+        advance = moved & (delta <= max_dist_threshold)
+        anchors[active[advance]] = candidate[advance]
+        finished = advance & (candidate == ends[active] - 1)
+        keep[candidate[finished]] = True
+        candidates[active] = candidate + 1
+        active = active[(advance | ~moved) & ~finished & (candidate + 1 < ends[active])]
+    trip_of, _ = trip_positions(offsets)
+    new_lengths = np.bincount(trip_of[keep], minlength=len(lengths))
+    return keep, np.concatenate([[0], np.cumsum(new_lengths)])
+
+
+def preprocess_arrays(longitudes, latitudes, times, offsets, **kwargs):
+    # note: runs the time, distance and speed filters of preprocess over a batch of trajectories stored
+    #  as coordinate and time arrays, each trajectory sorted by time and delimited by offsets.
+    #  returns the indices of the kept points and the offsets of the filtered trajectories.
+    time_threshold = kwargs['time_threshold'] if 'time_threshold' in kwargs else 20
+    max_dist_threshold = kwargs['max_dist_threshold'] if 'max_dist_threshold' in kwargs else 170
+    min_dist_threshold = kwargs['min_dist_threshold'] if 'min_dist_threshold' in kwargs else 5
+    max_spd_threshold = kwargs['max_spd_threshold'] if 'max_spd_threshold' in kwargs else 26
+    min_spd_threshold = kwargs['min_spd_threshold'] if 'min_spd_threshold' in kwargs else 2
+
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    times = to_epoch_ms(times)
+    indices = np.arange(len(longitudes))
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    seconds = np.zeros(len(indices), dtype=np.int64)
+    seconds[1:] = elapsed_seconds(times[1:], times[:-1])
+    keep, offsets = truncate_arrays(offsets, seconds > time_threshold)
+    indices = indices[keep]
+
+    keep, offsets = merge_arrays(
+        longitudes[indices], latitudes[indices], offsets, max_dist_threshold, min_dist_threshold
+    )
+    indices = indices[keep]
+
+    distances = np.zeros(len(indices), dtype=np.float64)
+    seconds = np.zeros(len(indices), dtype=np.int64)
+    distances[1:] = haversine_array(
+        latitudes[indices[:-1]], longitudes[indices[:-1]], latitudes[indices[1:]], longitudes[indices[1:]]
+    )
+    seconds[1:] = elapsed_seconds(times[indices[1:]], times[indices[:-1]])
+    speeds = speed_array(distances, seconds)
+    keep, offsets = truncate_arrays(offsets, (speeds > max_spd_threshold) | (speeds < min_spd_threshold))
+    return indices[keep], offsets
+
+
+def trip_arrays(trip):
+    longitudes = np.array([point[0] for point in trip], dtype=np.float64)
+    latitudes = np.array([point[1] for point in trip], dtype=np.float64)
+    times = to_epoch_ms([point[3] for point in trip])
+    return longitudes, latitudes, times, np.array([0, len(trip)])
 
 
 def dist_preprocess(trip, max_dist_threshold=170, min_dist_threshold=2):
-    filtered_trip = []
-    while len(trip) > 1:
-        org = trip.pop(0)
-        delta = dist_measure(org, trip[0])
-        if delta < min_dist_threshold:
-            _ = trip.pop(0)
-            trip.insert(0, org)
-            continue
-        filtered_trip.append(org)
-        if delta > max_dist_threshold:
-            break
-        if len(trip) == 1:
-            filtered_trip.append(trip.pop())
-    return filtered_trip
+    longitudes, latitudes, _, offsets = trip_arrays(trip)
+    keep, _ = merge_arrays(longitudes, latitudes, offsets, max_dist_threshold, min_dist_threshold)
+    return [trip[i] for i in np.flatnonzero(keep)]
 
 
 def spd_preprocess(trip, max_spd_threshold=25, min_spd_threshold=2):
     #note: this function just filter data based on avergae speed between two points, not based on the point gps point speed
-    filtered_trip = []
-    counter = 0
-    for org, dest in pairwise(trip):
-        delta = spd_measure(org, dest)
-        filtered_trip.append(org)
-        counter += 1
-        if delta > max_spd_threshold or delta < min_spd_threshold:
-            break
-        if counter == len(trip)-1:
-            filtered_trip.append(dest)
-    return filtered_trip
+    if len(trip) < 2:
+        return []
+    _, _, speeds = trip_steps(trip)
+    return truncate_trip(trip, (speeds > max_spd_threshold) | (speeds < min_spd_threshold))
 
 
 def preprocess(trip, **kwargs):
-    temp_trip = time_preprocess(
-        trip,
-        kwargs['time_threshold'] if 'time_threshold' in kwargs else 20
-    )
-    temp_trip = dist_preprocess(
-        temp_trip,
-        kwargs['max_dist_threshold'] if 'max_dist_threshold' in kwargs else 170,
-        kwargs['min_dist_threshold'] if 'min_dist_threshold' in kwargs else 5
-    )
-    temp_trip = spd_preprocess(
-        temp_trip,
-        kwargs['max_spd_threshold'] if 'max_spd_threshold' in kwargs else 26,
-        kwargs['min_spd_threshold'] if 'min_spd_threshold' in kwargs else 2
-    )
-    return temp_trip
+    if len(trip) == 0:
+        return []
+    indices, _ = preprocess_arrays(*trip_arrays(trip), **kwargs)
+    return [trip[i] for i in indices]
 
 
-def modify_data(file_path, boundary, global_index, **kwargs):
+def modify_data(file_path, boundary, global_index, start_time='', end_time='', **kwargs):
     print(file_path)
     data = pd.read_parquet(file_path)
     # data.sort_values(['route_slug'], inplace=True)
     # data.reset_index(drop=True, inplace=True)
 
-    data.timestamp = data.timestamp.apply(
-        lambda x: datetime.fromtimestamp(int(x) / 1000)
+    data['timestamp'] = to_epoch_ms(data.timestamp)
+    data['longitude'], data['latitude'] = decode_locations(data.location)
+    data['in_bound'] = (
+        (boundary['west'] < data.longitude) & (data.longitude < boundary['east']) &
+        (boundary['south'] < data.latitude) & (data.latitude < boundary['north'])
     )
-    data.location = data.location.apply(
-        lambda x: convert_location(x)
+    # note: points outside the time window are handled like out of bound points
+    start, end = time_range_ms(start_time, end_time)
+    if start is not None:
+        data['in_bound'] &= data.timestamp >= start
+    if end is not None:
+        data['in_bound'] &= data.timestamp <= end
+    # note: a trip is a run of consecutive in-bound points of the same route_slug. all the trips of the
+    #  file are sorted by time inside the run and filtered together by preprocess_arrays.
+    in_bound = data.in_bound.to_numpy()
+    route_slugs = data.route_slug.to_numpy()
+    starts = in_bound.copy()
+    starts[1:] &= ~in_bound[:-1] | (route_slugs[1:] != route_slugs[:-1])
+    rows = np.flatnonzero(in_bound)
+    run_ids = (np.cumsum(starts) - 1)[rows]
+    times = data.timestamp.to_numpy()
+    order = np.lexsort((times[rows], run_ids))
+    rows, run_ids = rows[order], run_ids[order]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(run_ids))]) if len(rows) else np.zeros(1, dtype=np.int64)
+    kept, offsets = preprocess_arrays(
+        data.longitude.to_numpy()[rows], data.latitude.to_numpy()[rows], times[rows], offsets, **kwargs
     )
-    data['in_bound'] = data.location.apply(
-        lambda x: boundary['west'] < x[0] < boundary['east'] and boundary['south'] < x[1] < boundary['north']
+    rows = rows[kept]
+    lengths = np.diff(offsets)
+    rows = rows[np.repeat(lengths > 1, lengths)]
+    lengths = lengths[lengths > 1]
+    trajectories = TrajectoryBatch(
+        global_index + np.arange(len(lengths)),
+        np.concatenate([[0], np.cumsum(lengths)]),
+        data.longitude.to_numpy()[rows],
+        data.latitude.to_numpy()[rows],
+        times[rows],
+        {column_name: data[column_name].to_numpy()[rows] for column_name in ['altitude', 'bearing', 'speed']}
     )
-    trajectories = []
-    temp_trip = []
-    # last_index = len(route_mapping)
-
-    # for i in range(len(data['device_id'])):
-    for i in range(len(data)-1):
-        if data.iloc[i]['in_bound']:
-            temp_trip.append([
-                data.iloc[i]['location'][0],
-                data.iloc[i]['location'][1],
-                data.iloc[i]['altitude'],
-                data.iloc[i]['timestamp'],
-                data.iloc[i]['bearing'],
-                data.iloc[i]['speed']
-            ])
-        else:
-            if len(temp_trip) > 1:
-                temp_trip = sorted(temp_trip, key=lambda x: x[3])
-                temp_trip = preprocess(temp_trip, **kwargs)
-                if len(temp_trip) > 1:
-                    # route_id = global_index
-                    # if data.iloc[i]['route_slug'] in route_mapping.keys():
-                    #     route_id = route_mapping[data.iloc[i]['route_slug']]
-                    # else:
-                    #     route_mapping[data.iloc[i]['route_slug']] = last_index
-                    #     route_id = last_index
-                    #     last_index += 1
-                    trajectories.append(
-                        (
-                            # np.int64(int(hashlib.md5(data.iloc[i]['route_slug'].encode('utf-8')).hexdigest(), 16) % (10**9)),
-                            global_index,
-                            temp_trip
-                        )
-                    )
-                    global_index += 1
-            temp_trip = []
-            continue
-
-        if data.iloc[i]['route_slug'] != data.iloc[i+1]['route_slug']:
-            if len(temp_trip) > 1:
-                temp_trip = sorted(temp_trip, key=lambda x: x[3])
-                temp_trip = preprocess(temp_trip, **kwargs)
-                if len(temp_trip) > 1:
-                    # if data.iloc[i]['route_slug'] in route_mapping.keys():
-                    #     route_id = route_mapping[data.iloc[i]['route_slug']]
-                    # else:
-                    #     route_mapping[data.iloc[i]['route_slug']] = last_index
-                    #     route_id = last_index
-                    #     last_index += 1
-                    trajectories.append(
-                        (
-                            global_index,
-                            temp_trip
-                        )
-                    )
-                    global_index += 1
-            temp_trip = []
     if len(trajectories) == 0:
         print('No bounded points')
-    return trajectories, global_index
+    return trajectories, global_index + len(trajectories)
+
 
+def modify_file(file_path, boundary, **kwargs):
+    # note: worker side of load_data, route ids of the returned trajectories start from 0
+    trajectories, n_routes = modify_data(file_path, boundary, 0, **kwargs)
+    return trajectories, n_routes
 
-def load_data(file_path, boundary, file_dist):
+
+def load_data(file_path, boundary, file_dist, workers=1, start_time='', end_time=''):
     if os.path.exists(file_path) is not True:
         print('Path does not exists!')
         return
@@ -202,24 +338,33 @@ def load_data(file_path, boundary, file_dist):
     ])
     # route_mapping = {}
     global_index = 0
-    for dir_name in [x for x in os.listdir(file_path) if os.path.isdir(os.path.join(file_path, x)) and not x.startswith('.')]:
-        if not os.path.exists(file_dist + '/' + prefix):
-            os.makedirs(file_dist + '/' + prefix)
-        files = sorted(os.listdir(os.path.join(file_path, dir_name)))
-        for file in files:
-            if not file.endswith('.parquet'):
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for dir_name in sorted([x for x in os.listdir(file_path) if os.path.isdir(os.path.join(file_path, x)) and not x.startswith('.')]):
+            # note: day partitions outside the time window are not listed
+            day = partition_day(dir_name)
+            if day is not None and not day_in_window(day, start_time, end_time):
                 continue
-            # trajectories, route_mapping = modify_data(os.path.join(file_path, dir_name, file), boundary, route_mapping)
-            trajectories, global_index = modify_data(os.path.join(file_path, dir_name, file), boundary, global_index)
-            if not trajectories:
-                continue
-            file_name = file_dist + '/' + prefix + '/' + file.split('.snappy')[0]+'.csv'
-            with open(file_name, 'w') as csv_file:
-                csv_writer = csv.writer(csv_file, delimiter=',', lineterminator='\n')
-                csv_writer.writerow(['route_id', 'longitude', 'latitude', 'altitude', 'timestamp', 'bearing', 'speed'])
-                for trajectory in trajectories:
-                    for point in trajectory[1]:
-                        csv_writer.writerow([trajectory[0]]+point)
+            if not os.path.exists(file_dist + '/' + prefix):
+                os.makedirs(file_dist + '/' + prefix)
+            files = sorted([x for x in os.listdir(os.path.join(file_path, dir_name)) if x.endswith('.parquet')])
+            full_paths = [os.path.join(file_path, dir_name, file) for file in files]
+            modify_worker = partial(modify_file, boundary=boundary, start_time=start_time, end_time=end_time)
+            modified_files = pool.map(modify_worker, full_paths) if pool is not None else map(modify_worker, full_paths)
+            # note: files are consumed in sorted order and local ids are shifted by the number of
+            #  trajectories of the previous files, so route ids are identical to a serial run
+            for file, (trajectories, n_routes) in zip(files, modified_files):
+                # trajectories, route_mapping = modify_data(os.path.join(file_path, dir_name, file), boundary, route_mapping)
+                if len(trajectories) == 0:
+                    continue
+                file_name = file_dist + '/' + prefix + '/' + file.split('.snappy')[0]+'.csv'
+                points_df = trajectories.to_points()
+                points_df['route_id'] += global_index
+                points_df.to_csv(file_name, sep=',', header=True, index=False)
+                global_index += n_routes
+    finally:
+        if pool is not None:
+            pool.shutdown()
     return file_dist + '/' + prefix + '/'
 
 
@@ -265,58 +410,116 @@ def make_trajs(file_path):
     return trajectories
 
 
+def sort_routes(points_df):
+    # note: a single stable sort by route id, the points of each route keep their order and the
+    #  returned offsets delimit the routes
+    points_df = points_df.sort_values(by='route_id', kind='stable')
+    points_df.reset_index(drop=True, inplace=True)
+    return points_df, route_offsets(points_df.route_id.to_numpy())
+
+
+def join_attribute(values, offsets):
+    # note: comma separated values of each route, every value is converted to string only once
+    values = np.asarray(values)
+    values = values.astype(str).tolist() if values.dtype.kind == 'f' else [str(x) for x in values.tolist()]
+    return [','.join(values[first:last]) for first, last in pairwise(offsets)]
+
+
+def build_trajectories(trajectories, offsets=None):
+    # note: builds the trajectories frame (id, geometry and comma separated altitude, bearing and speed) of
+    #  a TrajectoryBatch or a points frame in one pass. the line strings of all routes are encoded at once
+    #  from the coordinate arrays and the route offsets. routes with less than two points are dropped.
+    if not isinstance(trajectories, TrajectoryBatch):
+        if offsets is None:
+            trajectories, offsets = sort_routes(trajectories)
+        trajectories = TrajectoryBatch.from_points(trajectories, offsets)
+    if (trajectories.lengths < 2).any():
+        trajectories = trajectories[trajectories.lengths >= 2]
+    offsets = trajectories.offsets
+    buffer, byte_offsets = encode_linestrings(trajectories.longitudes, trajectories.latitudes, offsets)
+    geometries = [buffer[first:last].tobytes() for first, last in pairwise(byte_offsets)]
+    df = pd.DataFrame({
+        'id': trajectories.route_ids,
+        'altitude': join_attribute(trajectories.attributes['altitude'], offsets),
+        'bearing': join_attribute(trajectories.attributes['bearing'], offsets),
+        'speed': join_attribute(trajectories.attributes['speed'], offsets)
+    })
+    df = gp.GeoDataFrame(df, geometry=gp.GeoSeries([wkb.loads(geometry) for geometry in geometries], index=df.index))
+    return df[['id', 'geometry', 'altitude', 'bearing', 'speed']]
+
+
 def csv2trajs(dir_path):
     all_files = sorted(glob.glob(os.path.join(dir_path, "*.csv")))
     each_file_df = (pd.read_csv(f) for f in all_files)
     all_trajs = pd.concat(each_file_df, ignore_index=True)
-    all_trajs['pre_route_id'] = all_trajs.route_id.shift(1)
-    all_trajs = all_trajs[1:]
-    all_trajs['pre_route_id'] = all_trajs['pre_route_id'].astype(np.int32)
-    trajs_list = []
-    first, last = 0, 0
-    list2str = lambda x: ','.join([str(y) for y in x])
-    all_trajs.reset_index(drop=True, inplace=True)
-    for index, row in tqdm(all_trajs.iterrows(), total=len(all_trajs)):
-        if row['route_id'] != row['pre_route_id']:
-            last = index
-            idx_df = all_trajs.iloc[first:last]
-            traj_list = list(zip(idx_df.longitude.values, idx_df.latitude.values))
-            if len(traj_list) > 1:
-                trajs_list.append(
-                    (row['pre_route_id'], LineString(traj_list), list2str(idx_df.altitude.tolist()),
-                     list2str(idx_df.bearing.tolist()), list2str(idx_df.speed.tolist()))
-                )
-            first = index
-    return trajs_list
+    return build_trajectories(TrajectoryBatch.from_points(all_trajs))
 
 
 def trajToShape(source_path, dist_path):
     # trajectories = make_trajs(source_path)
-    trajectories = csv2trajs(source_path)
-    df = pd.DataFrame(trajectories, columns=['id', 'geometry', 'altitude', 'bearing', 'speed'])
-    df = gp.GeoDataFrame(df, geometry='geometry')
+    df = csv2trajs(source_path)
     df.to_file(dist_path, driver='ESRI Shapefile')
 
 
-def load_unmatched(file_path, unmatches, file_dist):
+def select_unmatched(full_path, unmatched_ids):
+    print(full_path)
+    if full_path.endswith('.parquet'):
+        temp_df = read_points(full_path)
+    else:
+        temp_df = pd.read_csv(full_path, sep=',')
+    return temp_df[temp_df.route_id.isin(unmatched_ids)]
+
+
+def load_unmatched(file_path, unmatches, file_dist, workers=1):
+    # note: every file is read once and its unmatched rows are appended to the output right away, membership
+    #  is a hash lookup on the route id index. csv chunk names are not route id ranges in general (tile and
+    #  partition chunks are named by row index), so every csv file is read. a trajectory store is read
+    #  instead when file_path is one, its file names are route id ranges and files without unmatched ids
+    #  are skipped.
     if os.path.exists(file_path) is not True:
         print('Path does not exists!')
         return
-    unmatch_trajs = pd.DataFrame()
-    for dir_name in [x for x in os.listdir(file_path) if os.path.isdir(os.path.join(file_path, x)) and not x.startswith('.')]:
-        if not os.path.exists(file_dist + '/unmatched'):
-            os.makedirs(file_dist + '/unmatched')
-        files = sorted(os.listdir(os.path.join(file_path, dir_name)))
-        for file in files:
-            if not file.endswith('.csv'):
-                continue
-            full_path = os.path.join(file_path, dir_name, file)
-            print(full_path)
-            temp_csv = pd.read_csv(full_path, sep=',', engine='python')
-            unmatch_trajs = pd.concat([unmatch_trajs, temp_csv[temp_csv.route_id.isin(unmatches)]])
+    unmatched_ids = np.unique(np.asarray(list(unmatches), dtype=np.int64))
+    full_paths = []
+    if is_store(file_path):
+        for store_file in store_files(file_path):
+            first_id, last_id = [int(x) for x in os.path.basename(store_file)[:-len('.parquet')].split('-')]
+            position = np.searchsorted(unmatched_ids, first_id)
+            if position < len(unmatched_ids) and unmatched_ids[position] <= last_id:
+                full_paths.append(store_file)
+    else:
+        for dir_name in sorted([x for x in os.listdir(file_path) if os.path.isdir(os.path.join(file_path, x)) and not x.startswith('.')]):
+            for file in sorted(os.listdir(os.path.join(file_path, dir_name))):
+                if file.endswith('.csv'):
+                    full_paths.append(os.path.join(file_path, dir_name, file))
 
+    if not os.path.exists(file_dist + '/unmatched'):
+        os.makedirs(file_dist + '/unmatched')
+    select_worker = partial(select_unmatched, unmatched_ids=pd.Index(unmatched_ids))
     file_name = file_dist + '/unmatched/unmatched.csv'
-    unmatch_trajs.to_csv(file_name, sep=',', header=True, index=False)
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pooled = None
+    try:
+        if pool is not None:
+            pooled = pooled_results(pool, (partial(select_worker, full_path) for full_path in full_paths), workers)
+            selections = pooled
+        else:
+            selections = map(select_worker, full_paths)
+        columns = None
+        with open(file_name, 'w') as csv_file:
+            for selection in selections:
+                # note: the header comes from the first file, even when none of its rows is unmatched
+                header = columns is None
+                if header:
+                    columns = list(selection.columns)
+                elif len(selection) == 0:
+                    continue
+                selection.reindex(columns=columns).to_csv(csv_file, sep=',', header=header, index=False)
+    finally:
+        if pooled is not None:
+            pooled.close()
+        if pool is not None:
+            pool.shutdown()
     return file_dist
 
 
@@ -360,50 +563,299 @@ def edgeToShape(map_dbpath, dist_path, min_length=20, n=5, no_postprocess=True):
     edges.to_file(dist_path, driver='ESRI Shapefile')
 
 
-def read_large_size(file_paths, boundary, start_time='', end_time='', has_distance=True):
-    all_df = []
-    start = datetime.fromisoformat(start_time)
-    end = datetime.fromisoformat(end_time)
-    for file_path in sorted(file_paths):
-        if not file_path.endswith('.parquet'):
+def time_range_ms(start_time='', end_time=''):
+    # note: converts the iso formatted time window to epoch milliseconds the way the raw timestamp
+    #  column is interpreted (datetime.fromtimestamp, i.e. local time). open ends are None. an end
+    #  given as a bare day (2021-06-09) includes the whole day.
+    start = int(datetime.fromisoformat(start_time).timestamp() * 1000) if start_time else None
+    end = None
+    if end_time and len(end_time) == len('YYYY-MM-DD'):
+        end = int((datetime.fromisoformat(end_time) + timedelta(days=1)).timestamp() * 1000) - 1
+    elif end_time:
+        end = int(datetime.fromisoformat(end_time).timestamp() * 1000)
+    return start, end
+
+
+def partition_day(dir_name):
+    # note: day of a day partition directory named <day> or <column>=<day>, None for other directories
+    try:
+        return datetime.strptime(dir_name.split('=')[-1], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def day_in_window(day, start_time='', end_time=''):
+    # note: days are local days, like the timestamps compared with the window
+    start, end = time_range_ms(start_time, end_time)
+    day_start, day_end = time_range_ms(day.isoformat(), day.isoformat())
+    return (start is None or day_end >= start) and (end is None or day_start <= end)
+
+
+def window_files(dir_path, start_time='', end_time=''):
+    # note: data files of a directory, either directly in it or in its day partition directories
+    #  (./data/gps-data/<day>/). day partitions outside the time window are skipped without being listed,
+    #  their files are never opened. other subdirectories are not data partitions and are not read, like
+    #  hidden files and files starting with '_' (e.g. _SUCCESS).
+    file_paths = []
+    for name in sorted(os.listdir(dir_path)):
+        if name.startswith('.') or name.startswith('_'):
             continue
-        print(file_path)
-        inbound_df = pd.read_parquet(file_path)
-        # print('shape inbound df after read: ', inbound_df.shape)
-        inbound_df['iso_timestamp'] = inbound_df.timestamp.apply(
-            lambda x: datetime.fromtimestamp(int(x) / 1000)
-        )
-        if start_time and end_time:
-            inbound_df = inbound_df[inbound_df.iso_timestamp.between(start, end)]
-        # print('shape inbound df after time filtering: ', inbound_df.shape)
-        inbound_df.location = inbound_df.location.apply(lambda x: convert_location(x))
-        inbound_df['longitude'] = inbound_df.location.apply(lambda x: x[0])
-        inbound_df['latitude'] = inbound_df.location.apply(lambda x: x[1])
-        inbound_df = inbound_df[
-            inbound_df.latitude.between(boundary['south'], boundary['north']) &
-            inbound_df.longitude.between(boundary['west'], boundary['east'])
+        path = os.path.join(dir_path, name)
+        if not os.path.isdir(path):
+            file_paths.append(path)
+            continue
+        day = partition_day(name)
+        if day is not None and day_in_window(day, start_time, end_time):
+            file_paths += window_files(path, start_time, end_time)
+    return file_paths
+
+
+def row_group_overlaps(row_group, column_indices, ranges):
+    # note: checks the min/max statistics of a row group against the requested ranges, a row group
+    #  is skipped only when the statistics exist, are numeric and prove that no row can match.
+    for column_name, (low, high) in ranges.items():
+        if column_name not in column_indices:
+            continue
+        stats = row_group.column(column_indices[column_name]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if not isinstance(stats.min, (int, float)) or not isinstance(stats.max, (int, float)):
+            continue
+        if low is not None and stats.max < low:
+            return False
+        if high is not None and stats.min > high:
+            return False
+    return True
+
+
+def compact_batch(batch_df):
+    # note: smaller dtypes for the memory budgeted mode, slugs and device ids as categoricals and
+    #  point attributes as float32. coordinates stay float64.
+    for column_name in COMPACT_FLOAT_COLUMNS:
+        batch_df[column_name] = batch_df[column_name].astype(np.float32)
+    for column_name in CATEGORICAL_COLUMNS:
+        batch_df[column_name] = batch_df[column_name].astype('category')
+    return batch_df
+
+
+def concat_compact(batches):
+    # note: concatenating categoricals with different categories falls back to objects, so the
+    #  categories of all the batches are unified (sorted, to keep the order of route_slug sorting) first
+    for column_name in CATEGORICAL_COLUMNS:
+        categories = union_categoricals([batch_df[column_name] for batch_df in batches], sort_categories=True).categories
+        for batch_df in batches:
+            batch_df[column_name] = batch_df[column_name].cat.set_categories(categories)
+    return pd.concat(batches, ignore_index=True)
+
+
+def iter_parquet_batches(file_path, boundary, start_time='', end_time='', has_distance=True, compact=False):
+    # note: streams a parquet file row group by row group. only the needed columns are read, row groups
+    #  outside the time window (and outside the boundary when the file already has decoded
+    #  longitude/latitude columns) are skipped from their statistics without being read, and each
+    #  yielded batch is already filtered by time and boundary.
+    parquet_file = pq.ParquetFile(file_path)
+    schema_names = parquet_file.schema_arrow.names
+    column_indices = {name: i for i, name in enumerate(schema_names)}
+    has_coords = 'longitude' in column_indices and 'latitude' in column_indices
+    columns = ['device_id', 'route_slug', 'altitude', 'timestamp', 'bearing', 'speed']
+    columns += ['longitude', 'latitude'] if has_coords else ['location']
+    if has_distance:
+        columns.append('distance')
+    start, end = time_range_ms(start_time, end_time)
+    ranges = {'timestamp': (start, end)}
+    if has_coords:
+        ranges['longitude'] = (boundary['west'], boundary['east'])
+        ranges['latitude'] = (boundary['south'], boundary['north'])
+    metadata = parquet_file.metadata
+    for rg_index in range(parquet_file.num_row_groups):
+        if not row_group_overlaps(metadata.row_group(rg_index), column_indices, ranges):
+            continue
+        batch_df = parquet_file.read_row_group(rg_index, columns=columns).to_pandas()
+        batch_df['timestamp'] = to_epoch_ms(batch_df.timestamp)
+        if start is not None or end is not None:
+            timestamps = batch_df.timestamp.to_numpy()
+            in_time = np.ones(len(batch_df), dtype=bool)
+            if start is not None:
+                in_time &= timestamps >= start
+            if end is not None:
+                in_time &= timestamps <= end
+            batch_df = batch_df[in_time]
+        if not has_coords:
+            batch_df['longitude'], batch_df['latitude'] = decode_locations(batch_df.location)
+            batch_df = batch_df.drop(columns='location')
+        batch_df = batch_df[
+            batch_df.latitude.between(boundary['south'], boundary['north']) &
+            batch_df.longitude.between(boundary['west'], boundary['east'])
         ]
-        # print('shape inbound df after location filtering: ', inbound_df.shape)
+        if len(batch_df) == 0:
+            continue
+        if compact:
+            batch_df = compact_batch(batch_df)
         if has_distance:
-            inbound_df = inbound_df[
+            batch_df = batch_df[
                 ['device_id', 'route_slug', 'latitude', 'longitude', 'altitude', 'timestamp', 'bearing', 'speed',
-                 'distance', 'iso_timestamp']
+                 'distance']
             ]
         else:
-            inbound_df = inbound_df[
-                ['device_id', 'route_slug', 'latitude', 'longitude', 'altitude', 'timestamp', 'bearing', 'speed',
-                 'iso_timestamp']
+            batch_df = batch_df[
+                ['device_id', 'route_slug', 'latitude', 'longitude', 'altitude', 'timestamp', 'bearing', 'speed']
             ]
-        all_df.append(inbound_df)
+        yield batch_df
+
+
+def record_keys(batch_df):
+    # note: 64 bit hash of the (device_id, timestamp) key of every record
+    return pd.util.hash_pandas_object(batch_df[['device_id', 'timestamp']], index=False).to_numpy()
+
+
+def sorted_contains(sorted_keys, keys):
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[positions] == keys
+
+
+def sorted_levels_contain(levels, keys):
+    # note: the keys are looked up in sorted order, which keeps the binary searches in the large arrays
+    #  cache friendly
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    contained = np.zeros(len(keys), dtype=bool)
+    for level_keys in levels:
+        contained[order] |= sorted_contains(level_keys, sorted_keys)
+    return contained
+
+
+def add_sorted_level(levels, keys):
+    # note: keys are kept in sorted arrays of decreasing sizes, the last arrays are merged when they get
+    #  close in size. adding the keys of every row group costs O(n log n) overall instead of sorting all
+    #  the keys again for every row group. only keys missing from the levels are added, so the arrays never
+    #  share keys and merging two of them is a stable sort of two sorted runs
+    levels.append(np.sort(keys))
+    while len(levels) > 1 and len(levels[-2]) <= 2 * len(levels[-1]):
+        last_keys = levels.pop()
+        levels[-1] = np.sort(np.concatenate([levels[-1], last_keys]), kind='stable')
+
+
+def file_keys(file_path, boundary, start_time='', end_time='', has_distance=True, compact=False):
+    # note: sorted keys of the records of a file in the time window and the boundary, the same keys a
+    #  serial read keeps for the file in the dedup window
+    try:
+        keys = [
+            record_keys(batch_df) for batch_df in iter_parquet_batches(
+                file_path, boundary, start_time, end_time, has_distance, compact
+            )
+        ]
+    except Exception:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(keys)) if keys else np.zeros(0, dtype=np.uint64)
+
+
+def iter_large_size(file_paths, boundary, start_time='', end_time='', has_distance=True, compact=False,
+                    dedup=False, seed_paths=(), dedup_window=DEDUP_WINDOW):
+    # note: with dedup, a record whose (device_id, timestamp) key was already read from the same file or from
+    #  one of the dedup_window previous files is dropped. the window holds the sorted keys of all the records
+    #  of those files in the time window and the boundary (duplicates included), so it only depends on the
+    #  files themselves. seed_paths are the files read before file_paths (e.g. the end of the previous
+    #  batch), their keys are read the same way and a batch is deduplicated exactly as in a serial read.
+    window_keys = deque(
+        [
+            file_keys(file_path, boundary, start_time, end_time, has_distance, compact)
+            for file_path in list(seed_paths)[-dedup_window:]
+        ] if dedup else [],
+        maxlen=dedup_window
+    )
+    duplicates = 0
+    for file_path in sorted(file_paths):
+        if not file_path.endswith('.parquet'):
+            continue
+        print(file_path)
+        if not dedup:
+            yield from iter_parquet_batches(file_path, boundary, start_time, end_time, has_distance, compact)
+            continue
+        levels = [np.unique(np.concatenate(window_keys))] if window_keys else []
+        all_keys = []
+        for batch_df in iter_parquet_batches(file_path, boundary, start_time, end_time, has_distance, compact):
+            keys = record_keys(batch_df)
+            fresh = np.zeros(len(keys), dtype=bool)
+            fresh[np.unique(keys, return_index=True)[1]] = True
+            fresh &= ~sorted_levels_contain(levels, keys)
+            duplicates += int((~fresh).sum())
+            add_sorted_level(levels, keys[fresh])
+            all_keys.append(keys)
+            if fresh.any():
+                yield batch_df[fresh]
+        window_keys.append(np.unique(np.concatenate(all_keys)) if all_keys else np.zeros(0, dtype=np.uint64))
+    if dedup:
+        print(f'{duplicates} duplicate records dropped')
+
+
+def read_large_size(file_paths, boundary, start_time='', end_time='', has_distance=True, compact=False,
+                    dedup=False, seed_paths=()):
+    all_df = list(iter_large_size(
+        file_paths, boundary, start_time, end_time, has_distance, compact, dedup, seed_paths
+    ))
+    if not all_df:
+        columns = ['device_id', 'route_slug', 'latitude', 'longitude', 'altitude', 'timestamp', 'bearing', 'speed']
+        columns += ['distance'] if has_distance else []
+        return pd.DataFrame(columns=columns)
+    if compact:
+        return concat_compact(all_df)
     all_df = pd.concat(all_df, ignore_index=True)
     return all_df
 
 
-def read_small_size(dir_path, boundary, has_distance=True):
-    all_df = pd.read_parquet(dir_path)
-    all_df.location = all_df.location.apply(lambda x: convert_location(x))
-    all_df['longitude'] = all_df.location.apply(lambda x: x[0])
-    all_df['latitude'] = all_df.location.apply(lambda x: x[1])
+def parse_memory_size(memory_size):
+    # note: parses sizes like 512M, 16G or a plain number of bytes
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    memory_size = str(memory_size).strip().upper().rstrip('B')
+    if memory_size and memory_size[-1] in units:
+        return int(float(memory_size[:-1]) * units[memory_size[-1]])
+    return int(float(memory_size))
+
+
+def files_for_budget(file_paths, memory_budget, workers=1, has_distance=True):
+    # note: number of files per batch so that all the batches held at once fit in the budget. with
+    #  workers, load_directory keeps at most `workers` batches prepared or waiting in shared memory (each
+    #  at its peak in the worker) while the parent holds the copies of the batch it is writing. rows per
+    #  file come from the parquet footers, the estimate ignores the time and boundary filters so it is on
+    #  the safe side.
+    rows_per_file = []
+    for file_path in file_paths:
+        if not file_path.endswith('.parquet'):
+            continue
+        try:
+            rows_per_file.append(pq.ParquetFile(file_path).metadata.num_rows)
+        except Exception:
+            continue
+    if not rows_per_file:
+        return 1
+    row_bytes = COMPACT_ROW_BYTES + (8 if has_distance else 0)
+    if workers > 1:
+        batch_copies = workers * PEAK_MEMORY_FACTOR + PARENT_BATCH_COPIES
+    else:
+        batch_copies = PEAK_MEMORY_FACTOR
+    batch_rows = memory_budget / (row_bytes * batch_copies)
+    return max(1, int(batch_rows / np.mean(rows_per_file)))
+
+
+def read_small_size(dir_path, boundary, has_distance=True, dedup=False, start_time='', end_time='', file_paths=None):
+    # note: file_paths (e.g. the files of the day partitions in the time window) are read instead of the
+    #  whole directory when given
+    if file_paths is None:
+        all_df = pd.read_parquet(dir_path)
+    else:
+        all_df = pd.concat([pd.read_parquet(file_path) for file_path in file_paths], ignore_index=True)
+    if dedup:
+        all_df = all_df.drop_duplicates(subset=['device_id', 'timestamp'])
+    all_df['timestamp'] = to_epoch_ms(all_df.timestamp)
+    start, end = time_range_ms(start_time, end_time)
+    if start is not None:
+        all_df = all_df[all_df.timestamp.to_numpy() >= start]
+    if end is not None:
+        all_df = all_df[all_df.timestamp.to_numpy() <= end]
+    all_df['longitude'], all_df['latitude'] = decode_locations(all_df.location)
+    all_df = all_df.drop(columns='location')
     all_df = all_df[
         all_df.latitude.between(boundary['south'], boundary['north']) &
         all_df.longitude.between(boundary['west'], boundary['east'])
@@ -421,34 +873,686 @@ def read_small_size(dir_path, boundary, has_distance=True):
 
 
 def save2outformat(input_df, out_format, out_dir, sp_thresh=None):
-    idxs = input_df.route_id.unique()
-    trajs_list = []
-    list2str = lambda x: ','.join([str(y) for y in x])
+    input_df, offsets = sort_routes(input_df)
+    idxs = input_df.route_id.to_numpy()[offsets[:-1]]
     if out_format == 'csv':
         split_parts = int(len(input_df) / min(sp_thresh, len(input_df)))
-        splitted_idxs = np.array_split(idxs, split_parts)
-        for arr in splitted_idxs:
-            file_name = os.path.join(out_dir, f'{arr[0]}-{arr[-1]}.csv')
-            input_df[input_df.route_id.isin(arr)].to_csv(file_name, sep=',', header=True, index=False)
-        for idx in idxs:
-            idx_df = input_df[input_df.route_id == idx]
-            traj_list = list(zip(idx_df.longitude.values, idx_df.latitude.values))
-            trajs_list.append(
-                (idx, LineString(traj_list), list2str(idx_df.altitude.tolist()),
-                 list2str(idx_df.bearing.tolist()), list2str(idx_df.speed.tolist()))
-            )
+        splitted_routes = np.array_split(np.arange(len(idxs)), split_parts)
+        for arr in splitted_routes:
+            file_name = os.path.join(out_dir, f'{idxs[arr[0]]}-{idxs[arr[-1]]}.csv')
+            input_df.iloc[offsets[arr[0]]:offsets[arr[-1] + 1]].to_csv(file_name, sep=',', header=True, index=False)
     elif out_format == 'txt':
-        for idx in idxs:
-            idx_df = input_df[input_df.route_id == idx]
-            idx_df.to_csv(f'trip_{idx}.txt', sep=' ', header=False, index=False)
-            traj_list = list(zip(idx_df.longitude.values, idx_df.latitude.values))
-            trajs_list.append(
-                (idx, LineString(traj_list), list2str(idx_df.altitude.tolist()),
-                 list2str(idx_df.bearing.tolist()), list2str(idx_df.speed.tolist()))
-            )
-    df = pd.DataFrame(trajs_list, columns=['id', 'geometry', 'altitude', 'bearing', 'speed'])
-    df = gp.GeoDataFrame(df, geometry='geometry')
-    return df
+        for idx, first, last in zip(idxs, offsets[:-1], offsets[1:]):
+            input_df.iloc[first:last].to_csv(f'trip_{idx}.txt', sep=' ', header=False, index=False)
+    return build_trajectories(input_df, offsets)
+
+
+def route_starts(all_df):
+    # note: a trajectory starts at the first point of the frame and wherever the route_slug changes
+    if isinstance(all_df.route_slug.dtype, pd.CategoricalDtype):
+        route_slugs = all_df.route_slug.cat.codes.to_numpy()
+    else:
+        route_slugs = all_df.route_slug.to_numpy()
+    starts = np.ones(len(all_df), dtype=bool)
+    starts[1:] = route_slugs[1:] != route_slugs[:-1]
+    return starts
+
+
+def drop_points(all_df, drop):
+    # note: removes points from the trajectories, when the first point of a trajectory is removed the
+    #  next kept point of the trajectory becomes its start
+    trip_ids = np.cumsum(all_df.new_trip.to_numpy())[~drop]
+    new_trip = np.ones(len(trip_ids), dtype=bool)
+    new_trip[1:] = trip_ids[1:] != trip_ids[:-1]
+    return all_df[~drop].assign(new_trip=new_trip)
+
+
+def split_points(all_df, breaks):
+    return all_df.assign(new_trip=all_df.new_trip.to_numpy() | breaks)
+
+
+# note: filter stages of load_directory. every stage takes the route sorted points frame (with the step
+#  columns delta_time, delta_dist and avg_speed to the previous point and the new_trip column marking
+#  trajectory starts) and a threshold, and returns the frame with points dropped or trajectories split.
+def spaced_points(times, trip_starts, threshold):
+    # note: greedy thinning of time sorted trajectories, a point is kept when it is more than threshold after
+    #  the last kept point of its trajectory. the next candidate of every point (its first later point of the
+    #  trajectory beyond threshold) is found by one binary search over all the points, then all trajectories
+    #  are walked at once from their first points, one kept point per step.
+    n_points = len(times)
+    starts = np.flatnonzero(trip_starts)
+    ends = np.repeat(np.append(starts[1:], n_points), np.diff(np.append(starts, n_points)))
+    targets = times + threshold
+    lo, hi = np.arange(1, n_points + 1), ends.copy()
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        later = times[np.minimum(mid, n_points - 1)] > targets
+        hi = np.where(active & later, mid, hi)
+        lo = np.where(active & ~later, mid + 1, lo)
+        active = lo < hi
+    keep = np.zeros(n_points, dtype=bool)
+    current = starts
+    while len(current):
+        keep[current] = True
+        current = lo[current][lo[current] < ends[current]]
+    return keep
+
+
+def duplicate_time_stage(all_df, threshold=0):
+    # note: drops points closer in time than threshold (ms) to the previous kept point of their trajectory,
+    #  so a run of close points is thinned to one point per threshold. with threshold 0 the previous kept
+    #  point has the time of the previous point, only repeated times are compared
+    times = all_df.timestamp.to_numpy()
+    new_trip = all_df.new_trip.to_numpy()
+    if threshold <= 0:
+        drop = np.zeros(len(all_df), dtype=bool)
+        drop[1:] = (times[1:] - times[:-1] <= threshold) & ~new_trip[1:]
+        return drop_points(all_df, drop)
+    return drop_points(all_df, ~spaced_points(times, new_trip, threshold))
+
+
+def min_distance_stage(all_df, threshold):
+    return drop_points(all_df, ~(all_df.delta_dist.to_numpy() > threshold))
+
+
+def time_gap_stage(all_df, threshold):
+    return split_points(all_df, all_df.delta_time.to_numpy() > threshold)
+
+
+def speed_jump_stage(all_df, threshold):
+    return split_points(all_df, all_df.avg_speed.to_numpy() > threshold)
+
+
+def distance_jump_stage(all_df, threshold):
+    return split_points(all_df, all_df.delta_dist.to_numpy() > threshold)
+
+
+def min_length_stage(all_df, threshold):
+    trip_ids = np.cumsum(all_df.new_trip.to_numpy()) - 1
+    lengths = np.bincount(trip_ids)[trip_ids] if len(trip_ids) else trip_ids
+    return drop_points(all_df, lengths < threshold)
+
+
+def segment_distances(longitudes, latitudes, firsts, lasts, points):
+    # note: distance (meters) of the points to the segments firsts-lasts, on a local equirectangular
+    #  projection around the first point of each segment
+    scale = np.pi / 180 * EARTH_RADIUS
+    x_scale = np.cos(np.radians(latitudes[firsts])) * scale
+    bx = (longitudes[lasts] - longitudes[firsts]) * x_scale
+    by = (latitudes[lasts] - latitudes[firsts]) * scale
+    px = (longitudes[points] - longitudes[firsts]) * x_scale
+    py = (latitudes[points] - latitudes[firsts]) * scale
+    squared_length = bx ** 2 + by ** 2
+    along = np.clip((px * bx + py * by) / np.where(squared_length > 0, squared_length, 1), 0, 1)
+    return np.hypot(px - along * bx, py - along * by)
+
+
+def simplify_arrays(longitudes, latitudes, offsets, tolerance):
+    # note: Douglas-Peucker simplification of all the trajectories at once. every step splits all the open
+    #  segments of all trajectories at their farthest point if it is farther than tolerance (meters) and
+    #  closes the others. returns the mask of kept points, the first and last point of a trajectory are kept.
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    firsts, lasts = offsets[:-1], offsets[1:] - 1
+    non_empty = lasts >= firsts
+    keep = np.zeros(offsets[-1], dtype=bool)
+    keep[firsts[non_empty]] = True
+    keep[lasts[non_empty]] = True
+    open_segments = lasts - firsts > 1
+    firsts, lasts = firsts[open_segments], lasts[open_segments]
+    while len(firsts):
+        lengths = lasts - firsts - 1
+        segment_of = np.repeat(np.arange(len(firsts)), lengths)
+        group_starts = np.cumsum(lengths) - lengths
+        points = firsts[segment_of] + 1 + np.arange(lengths.sum()) - group_starts[segment_of]
+        distances = segment_distances(longitudes, latitudes, firsts[segment_of], lasts[segment_of], points)
+        farthest = np.lexsort((-distances, segment_of))[group_starts]
+        split = distances[farthest] > tolerance
+        middles = points[farthest][split]
+        keep[middles] = True
+        firsts, lasts = np.concatenate([firsts[split], middles]), np.concatenate([middles, lasts[split]])
+        open_segments = lasts - firsts > 1
+        firsts, lasts = firsts[open_segments], lasts[open_segments]
+    return keep
+
+
+def simplify_stage(all_df, threshold):
+    # note: keeps the points (with their timestamps and attributes) needed to stay within threshold meters
+    #  of the original trajectories
+    offsets = np.concatenate([np.flatnonzero(all_df.new_trip.to_numpy()), [len(all_df)]])
+    keep = simplify_arrays(all_df.longitude.to_numpy(), all_df.latitude.to_numpy(), offsets, threshold)
+    return drop_points(all_df, ~keep)
+
+
+def stay_arrays(longitudes, latitudes, times, offsets, radius=20, min_duration=120):
+    # note: stay points of all the trajectories at once. from an anchor point the window grows while the
+    #  points stay within radius (meters) of the anchor, a window lasting at least min_duration (seconds)
+    #  is a stay and the scan continues after it, otherwise from the next point. the scan is sequential
+    #  inside a trajectory, so all trajectories are advanced together like in merge_arrays.
+    #  returns the first and the last point of every stay.
+    times = to_epoch_ms(times)
+    anchors = offsets[:-1].copy()
+    candidates = anchors + 1
+    ends = offsets[1:]
+    active = np.flatnonzero(np.diff(offsets) >= 2)
+    stay_firsts, stay_lasts = [], []
+    while active.size:
+        anchor, candidate, end = anchors[active], candidates[active], ends[active]
+        inside = candidate < end
+        inside[inside] = haversine_array(
+            latitudes[anchor[inside]], longitudes[anchor[inside]],
+            latitudes[candidate[inside]], longitudes[candidate[inside]]
+        ) <= radius
+        candidates[active[inside]] += 1
+        closed = ~inside
+        last = candidate[closed] - 1
+        is_stay = (last > anchor[closed]) & (elapsed_seconds(times[last], times[anchor[closed]]) >= min_duration)
+        stay_firsts.append(anchor[closed][is_stay])
+        stay_lasts.append(last[is_stay])
+        anchors[active[closed]] = np.where(is_stay, last + 1, anchor[closed] + 1)
+        candidates[active[closed]] = anchors[active[closed]] + 1
+        active = active[anchors[active] < ends[active] - 1]
+    if not stay_firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    stay_firsts, stay_lasts = np.concatenate(stay_firsts), np.concatenate(stay_lasts)
+    order = np.argsort(stay_firsts)
+    return stay_firsts[order], stay_lasts[order]
+
+
+def refresh_steps(all_df, rows):
+    # note: measures the steps (delta_time, delta_dist and avg_speed) of the given rows again from the
+    #  previous row of the frame, like segment_batch does (odometer differences when the frame has a
+    #  distance column). time steps start when the previous point was left, after its stay duration.
+    #  trajectory starts keep their steps.
+    rows = rows[rows > 0]
+    rows = rows[~all_df.new_trip.to_numpy()[rows]]
+    if len(rows) == 0:
+        return all_df
+    delta_time = all_df.delta_time.to_numpy().copy()
+    delta_dist = all_df.delta_dist.to_numpy().copy()
+    avg_speed = all_df.avg_speed.to_numpy().copy()
+    times = all_df.timestamp.to_numpy()
+    departures = times[rows - 1] + all_df.duration.to_numpy()[rows - 1] if 'duration' in all_df else times[rows - 1]
+    delta_time[rows] = elapsed_seconds(times[rows], departures)
+    if 'distance' in all_df:
+        distances = all_df.distance.to_numpy()
+        delta_dist[rows] = distances[rows] - distances[rows - 1]
+    else:
+        latitudes, longitudes = all_df.latitude.to_numpy(), all_df.longitude.to_numpy()
+        delta_dist[rows] = haversine_array(latitudes[rows], longitudes[rows], latitudes[rows - 1], longitudes[rows - 1])
+    avg_speed[rows] = speed_array(delta_dist[rows], delta_time[rows])
+    return all_df.assign(delta_time=delta_time, delta_dist=delta_dist, avg_speed=avg_speed)
+
+
+def stay_point_stage(all_df, threshold):
+    # note: collapses every stay into its first point moved to the centroid of the stay, the duration
+    #  column holds the length of the stay (ms, 0 for moving points). threshold is the radius (meters) or
+    #  a (radius, minimum duration in seconds) pair.
+    radius, min_duration = threshold if isinstance(threshold, tuple) else (threshold, STAY_MIN_DURATION)
+    offsets = np.concatenate([np.flatnonzero(all_df.new_trip.to_numpy()), [len(all_df)]])
+    times = all_df.timestamp.to_numpy()
+    firsts, lasts = stay_arrays(
+        all_df.longitude.to_numpy(), all_df.latitude.to_numpy(), times, offsets, radius, min_duration
+    )
+    durations = all_df.duration.to_numpy().copy() if 'duration' in all_df else np.zeros(len(all_df), dtype=np.int64)
+    if len(firsts) == 0:
+        return all_df.assign(duration=durations)
+    lengths = lasts - firsts + 1
+    members = np.repeat(firsts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    group_starts = np.cumsum(lengths) - lengths
+    longitudes, latitudes = all_df.longitude.to_numpy().copy(), all_df.latitude.to_numpy().copy()
+    longitudes[firsts] = np.add.reduceat(longitudes[members], group_starts) / lengths
+    latitudes[firsts] = np.add.reduceat(latitudes[members], group_starts) / lengths
+    durations[firsts] = to_epoch_ms(times[lasts]) - to_epoch_ms(times[firsts])
+    drop = np.zeros(len(all_df), dtype=bool)
+    drop[members] = True
+    drop[firsts] = False
+    # note: the moved stay points and the points right after the stays get their steps measured again,
+    #  from the moved point before them, so the following stages filter on the collapsed trajectories
+    moved = np.zeros(len(all_df), dtype=bool)
+    moved[firsts] = True
+    moved[lasts[lasts + 1 < len(all_df)] + 1] = True
+    all_df = all_df.assign(longitude=longitudes, latitude=latitudes, duration=durations)
+    all_df = drop_points(all_df, drop)
+    return refresh_steps(all_df, np.flatnonzero(moved[~drop]))
+
+
+FILTER_STAGES = {
+    'duplicate_time': duplicate_time_stage,
+    'min_distance': min_distance_stage,
+    'time_gap': time_gap_stage,
+    'speed_jump': speed_jump_stage,
+    'distance_jump': distance_jump_stage,
+    'min_length': min_length_stage,
+    'simplify': simplify_stage,
+    'stay_points': stay_point_stage
+}
+
+
+def default_filter_stages(min_dist_threshold=5, max_dist_threshold=100, max_time_threshold=10,
+                          max_spd_threshold=25):
+    return [
+        ('min_distance', min_dist_threshold),
+        ('time_gap', max_time_threshold),
+        ('speed_jump', max_spd_threshold),
+        ('distance_jump', max_dist_threshold),
+        ('min_length', 2)
+    ]
+
+
+def parse_filter_stages(stages):
+    # note: parses a stage list like "duplicate_time=0,min_distance=5,time_gap=10,min_length=2", stages
+    #  with more than one threshold separate them with colons (stay_points=20:120)
+    filter_stages = []
+    for stage in stages.split(','):
+        name, threshold = stage.strip().split('=')
+        if name not in FILTER_STAGES:
+            raise ValueError(f'Unknown filter stage {name}, available stages: {", ".join(FILTER_STAGES)}')
+        thresholds = tuple(float(x) for x in threshold.split(':'))
+        filter_stages.append((name, thresholds if len(thresholds) > 1 else thresholds[0]))
+    return filter_stages
+
+
+def run_filter_stages(all_df, filter_stages):
+    # note: runs the stages in order and returns the filtered frame and a frame of per-stage counters
+    #  (points and trajectories in and out, seconds spent)
+    all_df = all_df.assign(new_trip=route_starts(all_df))
+    stats = []
+    for name, threshold in filter_stages:
+        points_in, trips_in = len(all_df), int(all_df.new_trip.sum())
+        started = time.perf_counter()
+        all_df = FILTER_STAGES[name](all_df, threshold)
+        stats.append(dict(
+            stage=name, threshold=threshold,
+            points_in=points_in, points_out=len(all_df),
+            trips_in=trips_in, trips_out=int(all_df.new_trip.sum()),
+            seconds=time.perf_counter() - started
+        ))
+    return all_df, pd.DataFrame(stats, columns=FILTER_STATS_COLUMNS)
+
+
+def sketch_steps(all_df):
+    # note: sketches of the steps of the loaded points before filtering, steps across two routes are left out
+    same_route = ~route_starts(all_df)
+    return {measure: QuantileSketch().update(all_df[measure].to_numpy()[same_route]) for measure in SKETCH_MEASURES}
+
+
+def merge_sketches(sketches, batch_sketches):
+    if sketches is None:
+        return batch_sketches
+    for measure, sketch in sketches.items():
+        sketch.merge(batch_sketches[measure])
+    return sketches
+
+
+def suggest_thresholds(sketches):
+    return {
+        threshold_name: sketches[measure].quantile(q) for threshold_name, (measure, q) in SUGGESTED_THRESHOLDS.items()
+    }
+
+
+def merge_filter_stats(filter_stats, batch_stats):
+    if filter_stats is None:
+        return batch_stats
+    filter_stats = filter_stats.copy()
+    for column_name in FILTER_STATS_COLUMNS[2:]:
+        filter_stats[column_name] += batch_stats[column_name].to_numpy()
+    return filter_stats
+
+
+def assign_route_ids(all_df, first_route_id):
+    # note: route ids are contiguous and start from first_route_id
+    new_trip = all_df.new_trip.to_numpy()
+    trip_ids = np.cumsum(new_trip) - 1
+    all_df = all_df.drop(columns='new_trip')
+    all_df['ntraj_points'] = (np.bincount(trip_ids)[trip_ids] if len(trip_ids) else trip_ids).astype(np.int32)
+    all_df['route_id'] = (first_route_id + trip_ids).astype(np.int32)
+    return all_df, first_route_id + int(new_trip.sum())
+
+
+def segment_trajectories(all_df, first_route_id, max_time_threshold=10, max_spd_threshold=25,
+                         max_dist_threshold=100):
+    # note: a new trajectory starts wherever the route_slug changes or the step from the previous point
+    #  breaks one of the thresholds, trajectories with a single point are dropped
+    all_df, _ = run_filter_stages(all_df, [
+        ('time_gap', max_time_threshold),
+        ('speed_jump', max_spd_threshold),
+        ('distance_jump', max_dist_threshold),
+        ('min_length', 2)
+    ])
+    return assign_route_ids(all_df, first_route_id)
+
+
+def prepare_batch(
+        batch_paths, dir_path, boundary,
+        has_distance=True,
+        min_dist_threshold=5,
+        max_dist_threshold=100,
+        max_time_threshold=10,
+        max_spd_threshold=25,
+        large_size=True,
+        start_time='',
+        end_time='',
+        reorder=False,
+        compact=False,
+        filter_stages=None,
+        dedup=False,
+        seed_paths=()
+):
+    # note: reads, filters and segments one batch of files. route ids of the returned trajectories are
+    #  local to the batch (0 to n_routes-1), load_directory shifts them to global ids in batch order,
+    #  so batches can be prepared in any process and in any order.
+    if large_size:
+        print('loading from large size method')
+        all_df = read_large_size(batch_paths, boundary, start_time, end_time, has_distance, compact, dedup, seed_paths)
+    else:
+        print('loading from small size method')
+        all_df = read_small_size(dir_path, boundary, has_distance, dedup, start_time, end_time, batch_paths)
+        if compact:
+            all_df = compact_batch(all_df)
+    return segment_batch(
+        all_df, has_distance, min_dist_threshold, max_dist_threshold, max_time_threshold, max_spd_threshold,
+        reorder, filter_stages
+    )
+
+
+def segment_batch(
+        all_df,
+        has_distance=True,
+        min_dist_threshold=5,
+        max_dist_threshold=100,
+        max_time_threshold=10,
+        max_spd_threshold=25,
+        reorder=False,
+        filter_stages=None
+):
+    # note: sorts, filters and segments the records of a batch (or of a merged frame of the external sort)
+    print('***** Shape of records df before preprocessing: ', all_df.shape, '*****')
+    if len(all_df) == 0:
+        return None, 0, None, None
+
+    if reorder:
+        all_df['pre_route_slug'] = all_df.shift(1).route_slug
+        changed_idxs = list(all_df[all_df.pre_route_slug != all_df.route_slug].index)
+        changed_idxs.append(all_df.shape[0])
+        changed_idxs = np.array(list(pairwise(changed_idxs)))
+        repetitions = changed_idxs[:, 1] - changed_idxs[:, 0]
+        all_df['unique_route_slug'] = np.hstack([[i] * repetitions[i] for i in range(repetitions.shape[0])])
+        all_df.sort_values(by=['unique_route_slug', 'timestamp'], inplace=True)
+    else:
+        all_df.sort_values(by=['route_slug', 'timestamp'], inplace=True)
+
+    all_df.reset_index(drop=True, inplace=True)
+    times = all_df.timestamp.to_numpy()
+    all_df = all_df[1:]
+    all_df['delta_time'] = elapsed_seconds(times[1:], times[:-1])
+    if has_distance:
+        all_df['pr_distance'] = all_df.distance.shift(1)
+        all_df = all_df[1:]
+        all_df['delta_dist'] = all_df['distance'] - all_df['pr_distance']
+    else:
+        all_df['pr_latitude'] = all_df.latitude.shift(1)
+        all_df['pr_longitude'] = all_df.longitude.shift(1)
+        all_df = all_df[1:]
+        all_df['delta_dist'] = haversine_array(
+            all_df.latitude.to_numpy(), all_df.longitude.to_numpy(),
+            all_df.pr_latitude.to_numpy(), all_df.pr_longitude.to_numpy()
+        )
+
+    all_df['avg_speed'] = speed_array(all_df.delta_dist.to_numpy(), all_df.delta_time.to_numpy())
+    sketches = sketch_steps(all_df)
+
+    if filter_stages is None:
+        filter_stages = default_filter_stages(
+            min_dist_threshold, max_dist_threshold, max_time_threshold, max_spd_threshold
+        )
+    all_df, filter_stats = run_filter_stages(all_df, filter_stages)
+    all_df, n_routes = assign_route_ids(all_df, 0)
+    print('***** Shape of records df after preprocessing: ', all_df.shape, '*****')
+    all_df = all_df[
+        [
+            'route_id',
+            'longitude',
+            'latitude',
+            'altitude',
+            'timestamp',
+            'bearing',
+            'speed'
+        ] + (['duration'] if 'duration' in all_df else [])
+    ]
+    return all_df, n_routes, filter_stats, sketches
+
+
+MANIFEST_COLUMNS = ['path', 'size', 'mtime_ns', 'content_hash', 'first_route_id', 'last_route_id']
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, 'manifest.csv')
+    if not os.path.exists(manifest_path):
+        return pd.DataFrame(columns=MANIFEST_COLUMNS)
+    return pd.read_csv(manifest_path, sep=',', dtype={'path': str, 'content_hash': str})
+
+
+def write_manifest(manifest, output_dir):
+    # note: written to a temporary file first so an interrupted run never leaves a truncated manifest
+    manifest_path = os.path.join(output_dir, 'manifest.csv')
+    manifest.to_csv(manifest_path + '.tmp', sep=',', header=True, index=False)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def plan_incremental(dir_path, file_paths, manifest, output_dir):
+    # note: a file is processed again when it is new or its size, modification time and content hash
+    #  differ from the manifest (the hash is only computed when size or time changed). incremental loading
+    #  writes every file as its own batch, so only the store file of a changed file is removed and only
+    #  that file gets new route ids (after the largest ever assigned one). route ids of all the other files
+    #  stay the same. files of stores written in batches of several files share a range, those files still
+    #  have to be processed again with the changed one. files without trajectories have an empty range
+    #  and never share it. files deleted from dir_path are removed from the manifest and the store.
+    entries = manifest.set_index('path')
+    changed_files = []
+    for file_path in file_paths:
+        file_name = os.path.relpath(file_path, dir_path)
+        if file_name in entries.index:
+            entry = entries.loc[file_name]
+            file_stat = os.stat(file_path)
+            if entry['size'] == file_stat.st_size and entry['mtime_ns'] == file_stat.st_mtime_ns:
+                continue
+            if entry['size'] == file_stat.st_size and entry['content_hash'] == file_hash(file_path):
+                manifest.loc[manifest.path == file_name, 'mtime_ns'] = file_stat.st_mtime_ns
+                continue
+        changed_files.append(file_name)
+    deleted_files = [
+        file_name for file_name in manifest.path if not os.path.exists(os.path.join(dir_path, file_name))
+    ]
+    if deleted_files:
+        print(f'{len(deleted_files)} deleted files are removed from the store')
+    next_route_id = int(manifest.last_route_id.max()) + 1 if len(manifest) else 0
+    stale_entries = manifest[manifest.path.isin(set(changed_files) | set(deleted_files))]
+    stale_ranges = stale_entries[stale_entries.last_route_id >= stale_entries.first_route_id][
+        ['first_route_id', 'last_route_id']
+    ].drop_duplicates()
+    stale_entries = pd.concat(
+        [stale_entries, manifest.merge(stale_ranges, on=['first_route_id', 'last_route_id'])], ignore_index=True
+    ).drop_duplicates(subset='path')
+    for first_route_id, last_route_id in stale_ranges.itertuples(index=False):
+        # note: the store file of a range is named by the ids it holds, which can be narrower than the range
+        #  when routes at its ends were too short to store
+        for stale_store_file in store_files(output_dir, (int(first_route_id), int(last_route_id))):
+            os.remove(stale_store_file)
+    existing_files = set(os.path.relpath(file_path, dir_path) for file_path in file_paths)
+    process_files = sorted(set(changed_files) | (set(stale_entries.path) & existing_files))
+    renumbered_files = sorted(set(process_files) - set(changed_files))
+    if renumbered_files:
+        print(f'{len(renumbered_files)} unchanged files share a batch with changed files and get new route ids:')
+        for file_name in renumbered_files:
+            print(f'  {file_name}')
+    manifest = manifest[~manifest.path.isin(stale_entries.path)]
+    return [os.path.join(dir_path, file_name) for file_name in process_files], manifest, next_route_id
+
+
+def manifest_entries(dir_path, batch_paths, first_route_id, last_route_id):
+    entries = []
+    for file_path in batch_paths:
+        file_stat = os.stat(file_path)
+        entries.append([
+            os.path.relpath(file_path, dir_path), file_stat.st_size, file_stat.st_mtime_ns, file_hash(file_path),
+            first_route_id, last_route_id
+        ])
+    return pd.DataFrame(entries, columns=MANIFEST_COLUMNS)
+
+
+def spill_sorted_run(batch_paths, run_path, boundary, start_time='', end_time='', has_distance=True, compact=False,
+                     dedup=False, seed_paths=()):
+    # note: first phase of the external sort (worker side), one batch of files is read, sorted by route and
+    #  time and written as a sorted run. slugs and device ids are written as plain values so all the runs
+    #  compare them the same way.
+    all_df = read_large_size(batch_paths, boundary, start_time, end_time, has_distance, compact, dedup, seed_paths)
+    if len(all_df) == 0:
+        return None
+    for column_name in CATEGORICAL_COLUMNS:
+        if isinstance(all_df[column_name].dtype, pd.CategoricalDtype):
+            all_df[column_name] = all_df[column_name].astype(all_df[column_name].cat.categories.dtype)
+    all_df = all_df.sort_values(by=['route_slug', 'timestamp'], kind='stable')
+    all_df.to_parquet(run_path, index=False, row_group_size=MERGE_BATCH_ROWS)
+    return run_path
+
+
+def iter_row_groups(file_path):
+    # note: sorted runs are written in row groups of MERGE_BATCH_ROWS rows, so streaming them row group
+    #  by row group reads MERGE_BATCH_ROWS rows at a time
+    parquet_file = pq.ParquetFile(file_path)
+    for rg_index in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(rg_index)
+
+
+def merge_sorted_runs(run_paths, output_rows=MERGE_OUTPUT_ROWS):
+    # note: k-way merge of sorted runs. every run is streamed one row group at a time, the routes
+    #  before the smallest last route_slug of the loaded parts are complete in all the runs, so they are
+    #  merged (sorted by time) and yielded in frames of whole routes. memory holds one part per run plus the
+    #  rows of the routes that are still open.
+    readers = [iter_row_groups(run_path) for run_path in run_paths]
+    parts = [None] * len(readers)
+    exhausted = [False] * len(readers)
+
+    def refill(i):
+        for batch in readers[i]:
+            if batch.num_rows:
+                part = batch.to_pandas()
+                parts[i] = part if parts[i] is None else pd.concat([parts[i], part], ignore_index=True)
+                return
+        exhausted[i] = True
+
+    for i in range(len(readers)):
+        refill(i)
+    pending, pending_rows = [], 0
+    while True:
+        active = [i for i in range(len(readers)) if not exhausted[i]]
+        bound = min(parts[i].route_slug.iloc[-1] for i in active) if active else None
+        complete = []
+        for i in range(len(readers)):
+            if parts[i] is None or len(parts[i]) == 0:
+                continue
+            n_complete = len(parts[i]) if bound is None else int(np.searchsorted(
+                parts[i].route_slug.to_numpy(), bound, side='left'
+            ))
+            complete.append(parts[i].iloc[:n_complete])
+            parts[i] = parts[i].iloc[n_complete:].reset_index(drop=True)
+        if complete:
+            merged_df = pd.concat(complete, ignore_index=True)
+            pending.append(merged_df.sort_values(by=['route_slug', 'timestamp'], kind='stable'))
+            pending_rows += len(merged_df)
+        if pending_rows and (pending_rows >= output_rows or bound is None):
+            yield pd.concat(pending, ignore_index=True)
+            pending, pending_rows = [], 0
+        if bound is None:
+            return
+        for i in active:
+            if parts[i].route_slug.iloc[-1] == bound:
+                refill(i)
+
+
+def merge_to_run(run_paths, run_path):
+    # note: an intermediate pass of the merge, the merged runs are written as one sorted run
+    writer = None
+    for merged_df in merge_sorted_runs(run_paths, MERGE_BATCH_ROWS):
+        table = pa.Table.from_pandas(merged_df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(run_path, table.schema)
+        writer.write_table(table, row_group_size=MERGE_BATCH_ROWS)
+    if writer is not None:
+        writer.close()
+    return run_path
+
+
+def sorted_route_frames(run_paths, run_dir, compact=False):
+    # note: second phase of the external sort, yields the records of all the runs in frames of whole routes
+    #  sorted by route and time
+    merge_pass = 0
+    while len(run_paths) > MERGE_FAN_IN:
+        merged_paths = []
+        for first in range(0, len(run_paths), MERGE_FAN_IN):
+            merged_paths.append(merge_to_run(
+                run_paths[first:first + MERGE_FAN_IN], os.path.join(run_dir, f'merge-{merge_pass}-{first}.parquet')
+            ))
+            for run_path in run_paths[first:first + MERGE_FAN_IN]:
+                os.remove(run_path)
+        run_paths = merged_paths
+        merge_pass += 1
+    for merged_df in merge_sorted_runs(run_paths):
+        yield compact_batch(merged_df) if compact else merged_df
+
+
+def share_prepared(batch_worker, batch_paths, seed_paths=()):
+    # note: runs in a worker process. the prepared frame is handed back as a shared batch instead of being
+    #  pickled through the pool, only its path is sent back.
+    batch_df, n_routes, batch_stats, batch_sketches = batch_worker(batch_paths, seed_paths=seed_paths)
+    if batch_df is None:
+        return None, n_routes, batch_stats, batch_sketches
+    return TrajectoryBatch.from_points(batch_df).share(), n_routes, batch_stats, batch_sketches
+
+
+def attach_prepared(shared_path, n_routes, batch_stats, batch_sketches):
+    if shared_path is None:
+        return None, n_routes, batch_stats, batch_sketches
+    batch_df = TrajectoryBatch.attach(shared_path).to_points()
+    release_shared(shared_path)
+    return batch_df, n_routes, batch_stats, batch_sketches
+
+
+def release_prepared(prepared):
+    if prepared[0] is not None:
+        release_shared(prepared[0])
+
+
+def pooled_results(pool, jobs, in_flight, release=None):
+    # note: yields the results of the jobs in order. at most in_flight jobs are submitted and not yet
+    #  consumed, the next job is submitted when a result is consumed, so finished results never pile up
+    #  while the consumer is slower than the workers. when the consumer stops early (an error or close)
+    #  the queued jobs are cancelled and release is called on the finished results it never got.
+    jobs = iter(jobs)
+    futures = deque(pool.submit(job) for job in islice(jobs, in_flight))
+    try:
+        while futures:
+            result = futures.popleft().result()
+            futures.extend(pool.submit(job) for job in islice(jobs, 1))
+            yield result
+    finally:
+        for future in futures:
+            if future.cancel() or release is None:
+                continue
+            try:
+                release(future.result())
+            except Exception:
+                continue
 
 
 def load_directory(
@@ -465,124 +1569,294 @@ def load_directory(
         output_format='csv',
         start_time='',
         end_time='',
-        reorder=False
+        reorder=False,
+        workers=1,
+        incremental=False,
+        memory_budget=None,
+        filter_stages=None,
+        simplify_tolerance=None,
+        stay_radius=None,
+        stay_duration=STAY_MIN_DURATION,
+        dedup=False,
+        external_sort=False,
+        spill_dir=None
 ):
-    file_paths = [os.path.join(dir_path, file_name) for file_name in os.listdir(dir_path)]
-    total_files = len(file_paths)
-    read_files = 0
+    if external_sort and (incremental or reorder or not large_size):
+        print('External sort needs the large size method and can not be used with incremental or reorder!')
+        return
+    file_paths = window_files(dir_path, start_time, end_time)
     last_route_id = 0
-    while read_files < total_files:
-        if large_size:
-            print('loading from large size method')
-            all_df = read_large_size(file_paths[read_files:min(read_files + files_atonce, total_files)], boundary,
-                                     start_time, end_time, has_distance)
-        else:
-            print('loading from small size method')
-            all_df = read_small_size(dir_path, boundary, has_distance)
-        print('***** Shape of records df before preprocessing: ', all_df.shape, '*****')
-
-        if reorder:
-            all_df['pre_route_slug'] = all_df.shift(1).route_slug
-            changed_idxs = list(all_df[all_df.pre_route_slug != all_df.route_slug].index)
-            changed_idxs.append(all_df.shape[0])
-            changed_idxs = np.array(list(pairwise(changed_idxs)))
-            repetitions = changed_idxs[:, 1] - changed_idxs[:, 0]
-            all_df['unique_route_slug'] = np.hstack([[i] * repetitions[i] for i in range(repetitions.shape[0])])
-            all_df.sort_values(by=['unique_route_slug', 'iso_timestamp'], inplace=True)
-        else:
-            all_df.sort_values(by=['route_slug', 'iso_timestamp'], inplace=True)
-
-        all_df.reset_index(drop=True, inplace=True)
-        all_df['ntraj_points'] = 0
-        all_df['route_id'] = 0
-        all_df['pr_time'] = all_df.iso_timestamp.shift(1)
-        all_df = all_df[1:]
-        all_df['delta_time'] = all_df[['iso_timestamp', 'pr_time']].apply(
-            lambda x: (x.iso_timestamp - x.pr_time).seconds, axis=1
+    manifest = None
+    if incremental:
+        if output_format != 'parquet' or not large_size:
+            print('Incremental loading needs the parquet output format and the large size method!')
+            return
+        os.makedirs(output_dir, exist_ok=True)
+        file_paths = [file_path for file_path in file_paths if file_path.endswith('.parquet')]
+        file_paths, manifest, last_route_id = plan_incremental(dir_path, file_paths, read_manifest(output_dir), output_dir)
+        print(f'{len(file_paths)} new or changed files to load')
+    elif not file_paths:
+        print('No data files in the time window!')
+        return
+    total_files = len(file_paths)
+    if filter_stages is None and (simplify_tolerance is not None or stay_radius is not None):
+        filter_stages = default_filter_stages(
+            min_dist_threshold, max_dist_threshold, max_time_threshold, max_spd_threshold
         )
-        if has_distance:
-            all_df['pr_distance'] = all_df.distance.shift(1)
-            all_df = all_df[1:]
-            all_df['delta_dist'] = all_df['distance'] - all_df['pr_distance']
+    if stay_radius is not None:
+        # note: stays are collapsed first, before min_distance drops their points one pair at a time
+        filter_stages = [('stay_points', (stay_radius, stay_duration))] + filter_stages
+    if simplify_tolerance is not None:
+        # note: simplification runs on the final trajectories, after all the other stages
+        filter_stages = filter_stages + [('simplify', simplify_tolerance)]
+    if incremental:
+        # note: one file per batch, so every file has its own route id range in the manifest and a changed
+        #  file never renumbers the trajectories of the other files
+        files_atonce = 1
+    elif memory_budget is not None and large_size:
+        files_atonce = files_for_budget(file_paths, parse_memory_size(memory_budget), workers, has_distance)
+        print(f'{files_atonce} files at once for a memory budget of {memory_budget}')
+    if large_size:
+        batch_starts = list(range(0, total_files, files_atonce))
+        batches = [file_paths[read_files:min(read_files + files_atonce, total_files)] for read_files in batch_starts]
+    else:
+        batch_starts = [0]
+        batches = [file_paths]
+    batch_names = [
+        f'files-{read_files}-{min(read_files + files_atonce, total_files)}' for read_files in batch_starts
+    ]
+    batch_worker = partial(
+        prepare_batch,
+        dir_path=dir_path,
+        boundary=boundary,
+        has_distance=has_distance,
+        min_dist_threshold=min_dist_threshold,
+        max_dist_threshold=max_dist_threshold,
+        max_time_threshold=max_time_threshold,
+        max_spd_threshold=max_spd_threshold,
+        large_size=large_size,
+        start_time=start_time,
+        end_time=end_time,
+        reorder=reorder,
+        compact=memory_budget is not None,
+        filter_stages=filter_stages,
+        dedup=dedup
+    )
+    # note: with dedup every batch also gets the keys of the files just before it, so copies of a record
+    #  in two batches are dropped the same way as in a serial read, whatever process prepares the batch
+    batch_seeds = [
+        file_paths[max(0, read_files - DEDUP_WINDOW):read_files] if dedup and large_size else []
+        for read_files in batch_starts
+    ]
+
+    all_df = None
+    filter_stats = None
+    sketches = None
+    run_dir = None
+    pooled = None
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if external_sort:
+            # note: the batches are spilled as sorted runs (in parallel with workers) and merged, each merged
+            #  frame holds whole routes, so a route is never split between two batches. memory is bounded by
+            #  a batch while spilling and by the merge parts while merging, whatever the number of files.
+            run_dir = tempfile.mkdtemp(
+                prefix='sorted-runs-', dir=spill_dir or os.path.dirname(os.path.normpath(output_dir)) or '.'
+            )
+            spill_worker = partial(
+                spill_sorted_run,
+                boundary=boundary,
+                start_time=start_time,
+                end_time=end_time,
+                has_distance=has_distance,
+                compact=memory_budget is not None,
+                dedup=dedup
+            )
+            run_paths = [os.path.join(run_dir, f'run-{i}.parquet') for i in range(len(batches))]
+            if pool is not None:
+                pooled = pooled_results(pool, (
+                    partial(spill_worker, batch_paths, run_path, seed_paths=seed_paths)
+                    for batch_paths, run_path, seed_paths in zip(batches, run_paths, batch_seeds)
+                ), workers)
+                run_paths = list(pooled)
+            else:
+                run_paths = [
+                    spill_worker(batch_paths, run_path, seed_paths=seed_paths)
+                    for batch_paths, run_path, seed_paths in zip(batches, run_paths, batch_seeds)
+                ]
+            segment_worker = partial(
+                segment_batch,
+                has_distance=has_distance,
+                min_dist_threshold=min_dist_threshold,
+                max_dist_threshold=max_dist_threshold,
+                max_time_threshold=max_time_threshold,
+                max_spd_threshold=max_spd_threshold,
+                filter_stages=filter_stages
+            )
+            prepared_batches = (
+                segment_worker(merged_df) for merged_df in sorted_route_frames(
+                    [run_path for run_path in run_paths if run_path is not None], run_dir, memory_budget is not None
+                )
+            )
+            batch_names = (f'merged-{i}' for i in count())
+            batches = repeat([])
+        elif pool is not None:
+            # note: about workers batches are prepared or waiting in shared memory at once, the memory
+            #  budget of files_for_budget relies on it
+            pooled = pooled_results(pool, (
+                partial(share_prepared, batch_worker, batch_paths, seed_paths=seed_paths)
+                for batch_paths, seed_paths in zip(batches, batch_seeds)
+            ), workers, release_prepared)
+            prepared_batches = (attach_prepared(*prepared) for prepared in pooled)
         else:
-            all_df['pr_latitude'] = all_df.latitude.shift(1)
-            all_df['pr_longitude'] = all_df.longitude.shift(1)
-            all_df = all_df[1:]
-            all_df['delta_dist'] = all_df[
-                ['latitude', 'longitude', 'pr_latitude', 'pr_longitude']
-            ].apply(
-                lambda x: haversine(
-                    (x.latitude, x.longitude),
-                    (x.pr_latitude, x.pr_longitude),
-                    unit=Unit.METERS
-                ), axis=1
+            prepared_batches = (
+                batch_worker(batch_paths, seed_paths=seed_paths) for batch_paths, seed_paths in zip(batches, batch_seeds)
+            )
+        # note: batches are consumed in file order, so global route ids are identical to a serial run
+        for batch_name, batch_paths, (batch_df, n_routes, batch_stats, batch_sketches) in zip(
+                batch_names, batches, prepared_batches):
+            first_route_id = last_route_id
+            if batch_stats is not None:
+                filter_stats = merge_filter_stats(filter_stats, batch_stats)
+                sketches = merge_sketches(sketches, batch_sketches)
+            if batch_df is not None:
+                all_df = batch_df.assign(route_id=batch_df.route_id + last_route_id)
+                last_route_id += n_routes
+            if manifest is not None:
+                # note: the manifest is saved after every batch, an interrupted run loses at most one batch
+                if batch_df is not None:
+                    write_trajectories(all_df, output_dir)
+                manifest = pd.concat(
+                    [manifest, manifest_entries(dir_path, batch_paths, first_route_id, last_route_id - 1)],
+                    ignore_index=True
+                )
+                write_manifest(manifest, output_dir)
+                continue
+            if batch_df is None:
+                continue
+            if output_format == 'parquet':
+                # note: the trajectory store replaces both the csv chunks and the shape file
+                write_trajectories(all_df, output_dir)
+                continue
+            shapedf = save2outformat(
+                input_df=all_df,
+                out_format=output_format,
+                out_dir=output_dir,
+                sp_thresh=split_threshold
             )
+            save_path = shape_path.split('/')
+            save_path = '/'.join(save_path[:-1]) + f'/{batch_name}-' + save_path[-1]
+            shapedf.to_file(save_path, driver='ESRI Shapefile')
+    finally:
+        if pooled is not None:
+            pooled.close()
+        if pool is not None:
+            pool.shutdown()
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    if filter_stats is not None:
+        # note: counters of all the batches, to tune the thresholds from a single run. they are saved next
+        #  to the output directory to keep it free of other csv files
+        print(filter_stats.to_string(index=False))
+        filter_stats.to_csv(os.path.normpath(output_dir) + '-filter_stats.csv', sep=',', header=True, index=False)
+    if sketches is not None:
+        # note: thresholds suggested from the steps of all the loaded points, without a second pass. the
+        #  sketches are saved with them, sketches of other runs can be merged into them
+        thresholds = suggest_thresholds(sketches)
+        for threshold_name, value in thresholds.items():
+            print(f'suggested {threshold_name}: {value:.2f}')
+        with open(os.path.normpath(output_dir) + '-thresholds.json', 'w') as thresholds_file:
+            json.dump(dict(
+                thresholds=thresholds,
+                quantiles={threshold_name: q for threshold_name, (_, q) in SUGGESTED_THRESHOLDS.items()},
+                sketches={measure: sketch.to_dict() for measure, sketch in sketches.items()}
+            ), thresholds_file, indent=2)
+    return all_df
 
-        all_df['avg_speed'] = all_df[['delta_dist', 'delta_time']].apply(
-            lambda x: x.delta_dist / max(x.delta_time, 1), axis=1
-        )
 
-        all_df = all_df[all_df.delta_dist > min_dist_threshold]
-        first, last = 0, 0
-        for i in range(1, len(all_df)):
-
-            previous = all_df.iloc[i - 1]
-            current = all_df.iloc[i]
-
-            if any([
-                current['route_slug'] != previous['route_slug'],
-                current['delta_time'] > max_time_threshold,
-                current['avg_speed'] > max_spd_threshold,
-                current['delta_dist'] > max_dist_threshold
-            ]):
-                last = i
-                all_df.iloc[first:last]['ntraj_points'] = last - first
-                all_df.iloc[first:last]['route_id'] = last_route_id
-                last_route_id += 1
-                first = i
-        all_df = all_df[all_df.ntraj_points > 1]
-        print('***** Shape of records df after preprocessing: ', all_df.shape, '*****')
-        all_df = all_df[
-            [
-                'route_id',
-                'longitude',
-                'latitude',
-                'altitude',
-                'timestamp',
-                'bearing',
-                'speed'
-            ]
-        ]
-        shapedf = save2outformat(
-            input_df=all_df,
-            out_format=output_format,
-            out_dir=output_dir,
-            sp_thresh=split_threshold
-        )
-        save_path = shape_path.split('/')
-        save_path = '/'.join(save_path[:-1]) + \
-                     f'/files-{read_files}-{min(read_files + files_atonce, total_files)}-' + \
-                     save_path[-1]
-        shapedf.to_file(save_path, driver='ESRI Shapefile')
-        read_files += files_atonce
-        if not large_size:
-            break
-    return all_df
+def utm_zone(boundary):
+    # note: UTM zone (and hemisphere) of the center of the boundary
+    center_lon = (boundary['west'] + boundary['east']) / 2
+    center_lat = (boundary['south'] + boundary['north']) / 2
+    zone = int((center_lon + 180) // 6) % 60 + 1
+    return zone, center_lat < 0
 
 
-def datsetToUTM(dirpath, out_dir):
+def utm_projection(zone, south=False):
     from pyproj import Proj
-    wgs2utm = Proj(proj='utm', zone=39, ellps='WGS84', preserve_units=False)
+    return Proj(proj='utm', zone=zone, south=south, ellps='WGS84', preserve_units=False)
+
+
+def utm_crs(zone, south=False):
+    return f'EPSG:{(32700 if south else 32600) + zone}'
+
+
+def dataset_boundary(file_paths, from_store=False):
+    # note: bounds of the csv outputs (only the coordinate columns are read) or of a trajectory store
+    #  (from the bbox in the geo metadata of each file)
+    lons, lats = [], []
+    for file_path in file_paths:
+        if from_store:
+            geo_metadata = json.loads(pq.read_schema(file_path).metadata[b'geo'])
+            bbox = geo_metadata['columns']['geometry']['bbox']
+            if bbox:
+                lons += [bbox[0], bbox[2]]
+                lats += [bbox[1], bbox[3]]
+        else:
+            coords_df = pd.read_csv(file_path, sep=',', usecols=['longitude', 'latitude'])
+            if len(coords_df):
+                lons += [coords_df.longitude.min(), coords_df.longitude.max()]
+                lats += [coords_df.latitude.min(), coords_df.latitude.max()]
+    return dict(west=min(lons), east=max(lons), south=min(lats), north=max(lats))
+
+
+def project_file(file_path, out_dir, zone, south=False, from_store=False, to_store=False):
+    # note: worker of datsetToUTM, the coordinates of the whole file are projected with one call
+    if from_store:
+        temp_df = read_points(file_path)
+    else:
+        temp_df = pd.read_csv(file_path, sep=',')
+    temp_df = temp_df[temp_df.altitude.notna()]
+    if len(temp_df) == 0:
+        return None
+    wgs2utm = utm_projection(zone, south)
+    temp_df['longitude'], temp_df['latitude'] = wgs2utm(temp_df.longitude.to_numpy(), temp_df.latitude.to_numpy())
+    if to_store:
+        temp_df['timestamp'] = to_epoch_ms(temp_df.timestamp)
+        for column_name in ['bearing', 'speed']:
+            if column_name not in temp_df:
+                temp_df[column_name] = np.nan
+        return write_trajectories(temp_df, out_dir, crs=utm_crs(zone, south))
+    temp_df = temp_df[['route_id', 'longitude', 'latitude', 'altitude', 'timestamp']]
+    file_name = os.path.join(out_dir, os.path.basename(file_path).replace('.parquet', '.csv'))
+    temp_df.to_csv(file_name, sep=',', header=True, index=False)
+    return file_name
+
+
+def datsetToUTM(dirpath, out_dir, boundary=None, zone=None, workers=1, output_format='csv'):
+    # note: dirpath is a directory of csv outputs or a trajectory store. the UTM zone is picked from the
+    #  boundary (or the bounds of the dataset) unless given. with output_format 'parquet' the projected
+    #  trajectories are written as a trajectory store at out_dir instead of csv files.
+    from_store = is_store(dirpath) and not glob.glob(os.path.join(dirpath, '*.csv'))
+    if from_store:
+        file_paths = store_files(dirpath)
+    else:
+        file_paths = sorted(glob.glob(os.path.join(dirpath, '*.csv')))
+    if not file_paths:
+        print('No files to convert!')
+        return
+    south = False
+    if zone is None:
+        zone, south = utm_zone(boundary if boundary is not None else dataset_boundary(file_paths, from_store))
+    print(f'Converting to UTM zone {zone}{"S" if south else "N"} ({utm_crs(zone, south)})')
     os.makedirs(out_dir, exist_ok=True)
-    all_files = os.listdir(dirpath)
-    for file_name in tqdm(all_files, total=len(all_files)):
-        temp_df = pd.read_csv(os.path.join(dirpath, file_name), sep=',')
-        temp_df = temp_df[temp_df.altitude.notna()]
-        temp_df['coords'] = temp_df[['longitude', 'latitude']].apply(
-            lambda x: wgs2utm(x.longitude, x.latitude), axis=1
-        )
-        temp_df[['longitude', 'latitude']] = pd.DataFrame(
-            temp_df['coords'].tolist(), index=temp_df.index
-        )
-        temp_df = temp_df[['route_id', 'longitude', 'latitude', 'altitude', 'timestamp']]
-        temp_df.to_csv(os.path.join(out_dir, file_name), sep=',', header=True, index=False)
+    project_worker = partial(
+        project_file, out_dir=out_dir, zone=zone, south=south,
+        from_store=from_store, to_store=output_format == 'parquet'
+    )
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(tqdm(pool.map(project_worker, file_paths), total=len(file_paths)))
+    else:
+        for file_path in tqdm(file_paths, total=len(file_paths)):
+            project_worker(file_path)
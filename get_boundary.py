@@ -1,44 +1,108 @@
 import pandas as pd
+import pyarrow.parquet as pq
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 import os
-from filtering import convert_location
+from filtering import decode_locations, time_range_ms
+from epoch_time import to_epoch_ms
 
 
-def get_loc_boundary(dir_path, out_bound_file):
-    min_lat, min_lon, max_lat, max_lon = 1e3, 1e3, 0, 0
-    corrupted_files = []
-    total_records = 0
+BOUND_COLUMNS = ['longitude', 'latitude', 'timestamp']
+
+
+def statistics_bounds(row_group, column_index):
+    stats = row_group.column(column_index).statistics
+    if stats is None or not stats.has_min_max:
+        return None
+    if not isinstance(stats.min, (int, float)) or not isinstance(stats.max, (int, float)):
+        return None
+    return stats.min, stats.max
+
+
+def merge_bounds(bounds, other_bounds):
+    if bounds is None:
+        return other_bounds
+    if other_bounds is None:
+        return bounds
+    return min(bounds[0], other_bounds[0]), max(bounds[1], other_bounds[1])
+
+
+def file_bounds(file_path):
+    # note: min/max of longitude, latitude and timestamp (epoch ms) of a parquet file. row group statistics
+    #  are used where they exist and are numeric, otherwise only the missing columns of that row group
+    #  are read (the location column is decoded for the coordinates). returns None for corrupted files.
+    try:
+        parquet_file = pq.ParquetFile(file_path)
+        metadata = parquet_file.metadata
+        column_indices = {metadata.schema.column(i).name: i for i in range(metadata.num_columns)}
+        bounds = {'records': metadata.num_rows}
+        for row_group_index in range(metadata.num_row_groups):
+            row_group = metadata.row_group(row_group_index)
+            group_bounds = {
+                column_name: statistics_bounds(row_group, column_indices[column_name])
+                if column_name in column_indices else None for column_name in BOUND_COLUMNS
+            }
+            missing = [column_name for column_name, column_bounds in group_bounds.items() if column_bounds is None]
+            if missing and row_group.num_rows > 0:
+                read_columns = [column_name for column_name in missing if column_name in column_indices]
+                if 'location' in column_indices and \
+                        any(column_name not in column_indices for column_name in missing if column_name != 'timestamp'):
+                    read_columns.append('location')
+                group_df = parquet_file.read_row_group(row_group_index, columns=read_columns).to_pandas()
+                if 'location' in group_df:
+                    longitudes, latitudes = decode_locations(group_df.location)
+                    group_df = group_df.drop(columns='location')
+                    if 'longitude' not in group_df:
+                        group_df['longitude'] = longitudes
+                    if 'latitude' not in group_df:
+                        group_df['latitude'] = latitudes
+                for column_name in missing:
+                    if column_name not in group_df:
+                        continue
+                    if column_name == 'timestamp':
+                        # note: datetime and string timestamps are converted like the loaders do
+                        values = to_epoch_ms(group_df.timestamp)
+                        group_bounds[column_name] = int(values.min()), int(values.max())
+                    else:
+                        values = pd.to_numeric(group_df[column_name])
+                        group_bounds[column_name] = values.min(), values.max()
+            for column_name in BOUND_COLUMNS:
+                bounds[column_name] = merge_bounds(bounds.get(column_name), group_bounds[column_name])
+        return bounds
+    except Exception:
+        return None
+
+
+def dataset_bounds(dir_path, workers=1):
+    # note: bounds of all the files of a directory, files are processed in parallel with workers > 1.
+    #  corrupted files are collected from the same pass.
     file_paths = sorted([os.path.join(dir_path, file_name) for file_name in os.listdir(dir_path)])
-    for file_path in tqdm(file_paths, total=len(file_paths)):
-        try:
-            trajs = pd.read_parquet(file_path)
-            total_records += trajs.shape[0]
-            trajs.location = trajs.location.apply(
-                lambda x: convert_location(x)
-            )
-            trajs['longitude'] = trajs.location.apply(
-                lambda x: x[0]
-            )
-            trajs['latitude'] = trajs.location.apply(
-                lambda x: x[1]
-            )
-            temp_min_lat, temp_max_lat = trajs.latitude.min(), trajs.latitude.max()
-            temp_min_lon, temp_max_lon = trajs.longitude.min(), trajs.longitude.max()
-            if temp_min_lat < min_lat:
-                min_lat = temp_min_lat
-            if temp_max_lat > max_lat:
-                max_lat = temp_max_lat
-            if temp_min_lon < min_lon:
-                min_lon = temp_min_lon
-            if temp_max_lon > max_lon:
-                max_lon = temp_max_lon
-        except:
-            corrupted_files.append(file_path)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            all_bounds = list(tqdm(pool.map(file_bounds, file_paths, chunksize=8), total=len(file_paths)))
+    else:
+        all_bounds = [file_bounds(file_path) for file_path in tqdm(file_paths, total=len(file_paths))]
+    bounds = {'records': 0, 'files': len(file_paths), 'corrupted': []}
+    for file_path, file_bound in zip(file_paths, all_bounds):
+        if file_bound is None:
+            bounds['corrupted'].append(file_path)
+            continue
+        bounds['records'] += file_bound['records']
+        for column_name in BOUND_COLUMNS:
+            bounds[column_name] = merge_bounds(bounds.get(column_name), file_bound[column_name])
+    return bounds
+
+
+def get_loc_boundary(dir_path, out_bound_file, workers=1):
+    bounds = dataset_bounds(dir_path, workers)
+    corrupted_files = bounds['corrupted']
+    min_lat, max_lat = bounds.get('latitude') or (1e3, 0)
+    min_lon, max_lon = bounds.get('longitude') or (1e3, 0)
 
     print('Corrupted file: ', corrupted_files)
-    print('Total number of records: ', total_records)
-    print('Total number of files: ', len(file_paths))
+    print('Total number of records: ', bounds['records'])
+    print('Total number of files: ', bounds['files'])
     print('Total number of corrupted files: ', len(corrupted_files))
     print(f'Area Boundary: minimum latitude = {min_lat}, '
           f'maximum latitude = {max_lat}, '
@@ -52,23 +116,14 @@ def get_loc_boundary(dir_path, out_bound_file):
         bbox_file.write(txt2write)
 
 
-def get_time_boundary(dir_path, out_bound_file):
+def get_time_boundary(dir_path, out_bound_file, workers=1):
+    bounds = dataset_bounds(dir_path, workers)
     min_time, max_time = datetime.max, datetime.min
-    file_paths = sorted([os.path.join(dir_path, file_name) for file_name in os.listdir(dir_path)])
-    for file_path in tqdm(file_paths, total=len(file_paths)):
-        try:
-            trajs = pd.read_parquet(file_path)
-            trajs['timestamp'] = trajs.timestamp.apply(
-                lambda x: datetime.fromtimestamp(int(x) / 1000)
-            )
-            temp_min_time, temp_max_time = trajs.timestamp.min(), trajs.timestamp.max()
-            if temp_min_time < min_time:
-                min_time = temp_min_time
-            if temp_max_time > max_time:
-                max_time = temp_max_time
-        except:
-            pass
+    if bounds.get('timestamp') is not None:
+        min_time = datetime.fromtimestamp(int(bounds['timestamp'][0]) / 1000)
+        max_time = datetime.fromtimestamp(int(bounds['timestamp'][1]) / 1000)
 
+    print('Corrupted file: ', bounds['corrupted'])
     print(f'Time Boundary: minimum timestamp = {min_time}, maximum timestamp = {max_time}')
     with open(out_bound_file, 'w') as bbox_file:
         txt2write = f'MIN_TIMESTAMP={min_time}\n' + \
@@ -77,8 +132,7 @@ def get_time_boundary(dir_path, out_bound_file):
 
 def test(dir_path, out_time_bound_file, out_loc_bound_file):
     north, south, east, west = 35.7384, 35.7185, 51.3822, 51.3200
-    start = datetime.fromisoformat('2021-06-06 00:00:00')
-    end = datetime.fromisoformat('2021-06-06 23:59:59')
+    start, end = time_range_ms('2021-06-06 00:00:00', '2021-06-06 23:59:59')
     file_paths = sorted([os.path.join(dir_path, file_name) for file_name in os.listdir(dir_path)])
     total_records = 0
     counter = -1
@@ -89,19 +143,9 @@ def test(dir_path, out_time_bound_file, out_loc_bound_file):
         except:
             os.remove(file_path)
             continue
-        trajs['timestamp'] = trajs.timestamp.apply(
-            lambda x: datetime.fromtimestamp(int(x) / 1000)
-        )
+        trajs['timestamp'] = to_epoch_ms(trajs.timestamp)
         trajs = trajs[trajs.timestamp.between(start, end)]
-        trajs['location'] = trajs.location.apply(
-            lambda x: convert_location(x)
-        )
-        trajs['longitude'] = trajs.location.apply(
-            lambda x: x[0]
-        )
-        trajs['latitude'] = trajs.location.apply(
-            lambda x: x[1]
-        )
+        trajs['longitude'], trajs['latitude'] = decode_locations(trajs.location)
         trajs = trajs[
             trajs.latitude.between(south, north) & trajs.longitude.between(west, east)
         ]
@@ -111,9 +155,10 @@ def test(dir_path, out_time_bound_file, out_loc_bound_file):
 
     print(f'Total number of records: {total_records}')
 
-# dir_path = '/home/peymanbi/Downloads/loc-sample/'
-dir_path = '/media/peymanbi/Elements/teh_uni_loc_sample_2weeks_entire_city'
-out_loc_bound_file = './utils/full_area_loc_bounding_box.txt'
-# get_loc_boundary(dir_path, out_loc_bound_file)
-out_time_bound_file = './utils/full_area_time_bounding_box.txt'
-test(dir_path, out_time_bound_file, out_loc_bound_file)
\ No newline at end of file
+if __name__ == '__main__':
+    # dir_path = '/home/peymanbi/Downloads/loc-sample/'
+    dir_path = '/media/peymanbi/Elements/teh_uni_loc_sample_2weeks_entire_city'
+    out_loc_bound_file = './utils/full_area_loc_bounding_box.txt'
+    # get_loc_boundary(dir_path, out_loc_bound_file)
+    out_time_bound_file = './utils/full_area_time_bounding_box.txt'
+    test(dir_path, out_time_bound_file, out_loc_bound_file)
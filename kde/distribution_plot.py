@@ -1,88 +1,54 @@
 import pandas as pd
-import datetime
 import seaborn as sn
 import matplotlib.pyplot as plt
 import numpy as np
-from shapely import wkb
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from filtering import decode_locations, haversine_array, speed_array
+from epoch_time import to_epoch_ms, elapsed_seconds
+from quantile_sketch import QuantileSketch
 
 
 sample_file = 'data/gps-data/part-00001-498c167d-fb29-4098-a9f9-682631b98b93-c000.snappy'
-all_data = pd.read_parquet(sample_file)
+all_data = pd.read_parquet(sample_file, columns=['route_slug', 'timestamp', 'location'])
+
+# note: the points of each route are sorted by time and the steps are measured between consecutive points
+#  of the same route for the whole file at once, the same steps load_directory sketches while loading
+all_data['timestamp'] = to_epoch_ms(all_data.timestamp)
+all_data['longitude'], all_data['latitude'] = decode_locations(all_data.location)
+all_data = all_data.sort_values(by=['route_slug', 'timestamp'], kind='stable')
+route_slugs = all_data.route_slug.to_numpy()
+same_route = route_slugs[1:] == route_slugs[:-1]
+times = all_data.timestamp.to_numpy()
+latitudes, longitudes = all_data.latitude.to_numpy(), all_data.longitude.to_numpy()
 
 ########################## time interval distribution plot ############################
-intervals = []
-temp_times = []
-for i in range(5000):
-    print(datetime.datetime.fromtimestamp(int(all_data.iloc[i]['timestamp'])/1000))
-    temp_times.append(datetime.datetime.fromtimestamp(int(all_data.iloc[i]['timestamp'])/1000))
-    if all_data.iloc[i]['route_slug'] != all_data.iloc[i+1]['route_slug']:
-        temp_times = sorted(temp_times)
-        temp_times = [(temp_times[i+1]-temp_times[i]).seconds for i in range(len(temp_times)-1)]
-        intervals += temp_times
-        temp_times = []
+intervals = elapsed_seconds(times[1:], times[:-1])[same_route]
 
 sn.displot(intervals, color='r')
 plt.xlabel('time intervals')
 plt.savefig('time distribution')
 # ===> time threshold = 20 s
+print('time threshold (95%):', QuantileSketch().update(intervals).quantile(0.95))
 
 ########################### ditance interval distribution plot #############################
 
-METERS_PER_DEGREE_LATITUDE = 111070.34306591158
-METERS_PER_DEGREE_LONGITUDE = 83044.98918812413
-
-dists = []
-temp_trip = []
-dist_measure = lambda x, y: np.sqrt((x[0]-y[0])**2+(x[1]-y[1])**2)
-for i in range(20000):
-    point = wkb.loads(all_data.iloc[i]['location'], hex=True)
-    temp_trip.append([
-        point.x*METERS_PER_DEGREE_LONGITUDE,
-        point.y*METERS_PER_DEGREE_LATITUDE,
-        datetime.datetime.fromtimestamp(int(all_data.iloc[i]['timestamp'])/1000)
-    ])
-    if all_data.iloc[i]['route_slug'] != all_data.iloc[i+1]['route_slug']:
-        temp_trip = sorted(temp_trip, key=lambda x: x[2])
-        temp_trip = [
-            dist_measure(temp_trip[i], temp_trip[i+1]) for i in range(len(temp_trip)-1)
-        ]
-        dists += temp_trip
-        temp_trip = []
+dists = haversine_array(latitudes[1:], longitudes[1:], latitudes[:-1], longitudes[:-1])[same_route]
 
 sn.displot(dists)
 plt.xlabel('distance intervals')
 plt.savefig('distance distribution')
 
-bin_values, edges = np.histogram(dists, bins=300)
-bin_cum = np.cumsum(bin_values)
-bin_cum = bin_cum/bin_cum[-1]
-threshold = int(edges[np.argmin(abs(bin_cum-0.15))+1])
+threshold = QuantileSketch().update(dists).quantile(0.15)
+print('distance threshold (15%):', threshold)
 
 ########################### speed interval distribution plot #################################
 
-velocities = []
-temp_trip = []
-vel_measure = lambda x, y: np.sqrt((x[0]-y[0])**2+(x[1]-y[1])**2)/max((y[2]-x[2]).seconds, 1)# for i in range(len(all_data)-1):
-for i in range(20000):
-    point = wkb.loads(all_data.iloc[i]['location'], hex=True)
-    temp_trip.append([
-        point.x*83044.98918812413,
-        point.y*111070.34306591158,
-        datetime.datetime.fromtimestamp(int(all_data.iloc[i]['timestamp'])/1000)
-    ])
-    if all_data.iloc[i]['route_slug'] != all_data.iloc[i+1]['route_slug']:
-        temp_trip = sorted(temp_trip, key=lambda x: x[2])
-        temp_trip = [
-            vel_measure(temp_trip[i], temp_trip[i+1]) for i in range(len(temp_trip)-1)
-        ]
-        velocities += temp_trip
-        temp_trip = []
+velocities = speed_array(dists, intervals)
 
 sn.displot(velocities, color='g')
 plt.xlabel('average speed')
 plt.savefig('average speed distribution')
 
-bin_values, edges = np.histogram(velocities, bins=300)
-bin_cum = np.cumsum(bin_values)
-bin_cum = bin_cum/bin_cum[-1]
-threshold = int(edges[np.argmin(abs(bin_cum-0.1))+1])
\ No newline at end of file
+threshold = QuantileSketch().update(velocities).quantile(0.1)
+print('speed threshold (10%):', threshold)
@@ -1,8 +1,14 @@
 from graphdb_matcher import GraphDBMatcher
 import spatialfunclib
-import math, csv
+import math, csv, io, os, sys
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traj_store import is_store, store_files, parse_id_range, TrajectoryBatch, release_shared
+from epoch_time import elapsed_seconds
 
 # ambiguity: difference between this threshold and the one in graphdb_matcher is ambiguous
 max_viterbi_subdivision = 10.0
@@ -12,7 +18,7 @@ class MatchGraphDB:
         self.matcher = GraphDBMatcher(graphdb_filename, constraint_length, max_dist)
         self.constraint_length = constraint_length
 
-    def process_trip(self, trips, csv_writer):
+    def process_trip(self, trip, csv_writer):
 
         # note: V is the viterbi matrix. It is a dictionary with
         #  nodes as key of type (latitude, longitude) and viterbi probability as value
@@ -28,11 +34,15 @@ class MatchGraphDB:
         obs_states = []
         max_prob_p = None
 
-        first_obs = trips.iloc[0]
-        first_obs_id = first_obs['route_id']
-        first_obs_lat = first_obs['latitude']
-        first_obs_lon = first_obs['longitude']
-        first_obs_time = first_obs['timestamp']
+        # note: trip is a single route TrajectoryBatch, its columns are taken as python lists once.
+        #  observation times are epoch milliseconds.
+        route_id = trip.route_ids[0].item()
+        lats, lons, times = trip.latitudes.tolist(), trip.longitudes.tolist(), trip.timestamps.tolist()
+
+        first_obs_id = route_id
+        first_obs_lat = lats[0]
+        first_obs_lon = lons[0]
+        first_obs_time = times[0]
 
         # note: matcher computes viterbi matrix for each transition.
         V, p = self.matcher.step((float(first_obs_lat), float(first_obs_lon)), V, p)
@@ -62,14 +72,13 @@ class MatchGraphDB:
         #  add the path to the last point of the trips which should be in the same length of the all observed
         #  nodes on the trip.
 
-        for i in range(1, len(trips)):
-            prev_point, curr_point = trips.iloc[i-1], trips.iloc[i]
-            prev_lat, prev_lon = prev_point['latitude'], prev_point['longitude']
-            prev_time = datetime.strptime(prev_point['timestamp'][:19], '%Y-%m-%d %H:%M:%S')
-            curr_lat, curr_lon = curr_point['latitude'], curr_point['longitude']
-            curr_time = datetime.strptime(curr_point['timestamp'][:19], '%Y-%m-%d %H:%M:%S')
+        for i in range(1, trip.num_points):
+            prev_lat, prev_lon = lats[i-1], lons[i-1]
+            prev_time = times[i-1]
+            curr_lat, curr_lon = lats[i], lons[i]
+            curr_time = times[i]
 
-            elapsed_time = (curr_time - prev_time).seconds
+            elapsed_time = int(elapsed_seconds(curr_time, prev_time))
 
             distance = spatialfunclib.distance((float(prev_lat), float(prev_lon)), (float(curr_lat), float(curr_lon)))
 
@@ -92,7 +101,7 @@ class MatchGraphDB:
                     if len(max_prob_p) == self.constraint_length:
                         obs_states.append(max_prob_p[0])
 
-                    obs.append((curr_point['route_id'], int_step_lat, int_step_lon, prev_time + timedelta(seconds=int(j*int_step_time))))
+                    obs.append((route_id, int_step_lat, int_step_lon, prev_time + int(j*int_step_time)*1000))
 
             V, p = self.matcher.step((float(curr_lat), float(curr_lon)), V, p)
 
@@ -102,7 +111,7 @@ class MatchGraphDB:
             if len(max_prob_p) == self.constraint_length:
                 obs_states.append(max_prob_p[0])
 
-            obs.append((curr_point['route_id'], curr_lat, curr_lon, curr_time))
+            obs.append((route_id, curr_lat, curr_lon, curr_time))
 
         if len(max_prob_p) < self.constraint_length:
             obs_states.extend(max_prob_p)
@@ -124,6 +133,41 @@ class MatchGraphDB:
 
             csv_writer.writerow(row)
 
+
+def init_match_worker(graphdb_filename, constraint_length, max_dist, max_division_dist):
+    # note: every worker process opens the graph once and keeps its own matcher
+    global match_graphdb, max_viterbi_subdivision
+    match_graphdb = MatchGraphDB(graphdb_filename, constraint_length, max_dist)
+    max_viterbi_subdivision = max_division_dist
+
+
+def match_routes(shared_path, positions):
+    # note: runs in a worker process attached to the shared batch of a file, the matched rows of the
+    #  routes are returned as csv text
+    batch = TrajectoryBatch.attach(shared_path)
+    csv_file = io.StringIO()
+    csv_writer = csv.writer(csv_file, delimiter=',', lineterminator='\n')
+    for position in positions:
+        match_graphdb.process_trip(batch[position], csv_writer)
+    return csv_file.getvalue()
+
+
+def match_batch(batch, csv_file, pool=None, workers=1):
+    # note: routes with at least two points are matched in route order. with a pool the batch is shared once
+    #  and the workers match consecutive chunks of its routes, their rows are written in the same order.
+    positions = np.flatnonzero(batch.lengths >= 2)
+    if pool is None:
+        csv_writer = csv.writer(csv_file, delimiter=',', lineterminator='\n')
+        for position in positions:
+            match_graphdb.process_trip(batch[position], csv_writer)
+        return
+    shared_path = batch.share()
+    try:
+        for rows in pool.map(partial(match_routes, shared_path), np.array_split(positions, workers * 4)):
+            csv_file.write(rows)
+    finally:
+        release_shared(shared_path)
+
 import os
 import argparse
 
@@ -133,12 +177,16 @@ if __name__ == '__main__':
     parser.add_argument('--input_graph_file', type=str, help='Path to graph sqlite database file')
     parser.add_argument('--trajs_path', type=str, help='Path to gps trajectories')
     parser.add_argument('--match_output_path', type=str, help='Directory to save matched trajectories')
+    parser.add_argument('--id_range', type=str, default='',
+                        help='Range of route ids to match when trajs_path is a trajectory store (first-last)')
     parser.add_argument('--max_v_length', type=float, default=300,
                         help='Maximum length to extend paths in viterbi algorithm')
     parser.add_argument('--max_r_dist', type=float, default=500,
                         help='Maximum distance to detect nearby areas in Rtree algorithm (areas are representations of map edges)')
     parser.add_argument('--max_division_dist', type=float, default=10.0,
                         help='Maximum distance to devide edges in Viterbi algorithm (unit: meters)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes matching the routes of each file')
     args = parser.parse_args()
     
     graphdb_filename = args.input_graph_file
@@ -155,6 +203,28 @@ if __name__ == '__main__':
     print("output directory: " + str(output_directory))
     
     match_graphdb = MatchGraphDB(graphdb_filename, constraint_length, max_dist)
+    pool = ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_match_worker,
+        initargs=(graphdb_filename, constraint_length, max_dist, max_viterbi_subdivision)
+    ) if args.workers > 1 else None
+
+    if is_store(trip_directory):
+        # note: each store file is matched to a csv file of the same name, only the needed columns
+        #  of the requested route id range are loaded
+        id_range = parse_id_range(args.id_range)
+        store_name = os.path.basename(os.path.normpath(trip_directory))
+        if not os.path.exists(os.path.join(output_directory, store_name)):
+            os.makedirs(os.path.join(output_directory, store_name))
+        for store_file in store_files(trip_directory, id_range):
+            full_outputpath = os.path.join(output_directory, store_name, os.path.basename(store_file)[:-len('.parquet')] + '.csv')
+            batch = TrajectoryBatch.read(store_file, ['latitude', 'longitude', 'timestamp'], id_range)
+            with open(full_outputpath, 'w') as csv_file:
+                print(full_outputpath)
+                match_batch(batch, csv_file, pool, args.workers)
+        if pool is not None:
+            pool.shutdown()
+        print("done.\n")
+        exit()
 
     for dir_name in [x for x in os.listdir(trip_directory) if os.path.isdir(os.path.join(trip_directory, x)) and not x.startswith('.')]:
         if not os.path.exists(os.path.join(output_directory, dir_name)):
@@ -171,17 +241,11 @@ if __name__ == '__main__':
             if os.path.exists(full_inputpath) is not True:
                 print('Path does not exists!')
                 continue
-            temp_trips = pd.read_csv(full_inputpath, sep=',', header=0, engine='python')
+            # note: every route of the file is matched, including the last one
+            batch = TrajectoryBatch.from_points(pd.read_csv(full_inputpath, sep=',', header=0, engine='python'))
             with open(full_outputpath, 'w') as csv_file:
                 print(full_outputpath)
-                first, last = 0, 0
-                csv_writer = csv.writer(csv_file, delimiter=',', lineterminator='\n')
-                for i in range(len(temp_trips) - 1):
-                    point = temp_trips.iloc[i]
-                    last += 1
-                    if point['route_id'] != temp_trips.iloc[i + 1]['route_id']:
-                        if last-first >= 2:
-                            match_graphdb.process_trip(temp_trips.iloc[first:last], csv_writer)
-
-                        first = last
+                match_batch(batch, csv_file, pool, args.workers)
+    if pool is not None:
+        pool.shutdown()
     print("done.\n")
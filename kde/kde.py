@@ -5,7 +5,11 @@ from pylibs import spatialfunclib
 from haversine import haversine, Unit
 from itertools import tee
 import numpy as np
-import argparse, os
+import argparse, os, shutil, tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traj_store import parse_id_range, TrajectoryBatch, release_shared, SHARED_DIR
 import imageio
 
 
@@ -20,7 +24,22 @@ class KDE:
     def __init__(self):
         pass
 
-    def create_kde_with_trips(self, all_trips):
+    def trip_pixels(self, all_trips, height, xscale, yscale):
+        # note: pixel coordinates of the locations of every trip. for a TrajectoryBatch they are computed
+        #  for all the points at once and sliced by route.
+        if isinstance(all_trips, TrajectoryBatch):
+            all_trips = all_trips[all_trips.lengths >= 2]
+            xs = (xscale * (all_trips.longitudes - min_lon)).astype(int)
+            ys = height - (yscale * (all_trips.latitudes - min_lat)).astype(int)
+            return [(xs[first:last].tolist(), ys[first:last].tolist()) for _, first, last in all_trips.routes()]
+        return [
+            (
+                [int(xscale * (location.longitude - min_lon)) for location in trip.locations],
+                [height - int(yscale * (location.latitude - min_lat)) for location in trip.locations]
+            ) for trip in all_trips
+        ]
+
+    def create_kde_with_trips(self, all_trips, pool=None, workers=1):
 
         print("trips path: " + str(trips_path))
         print("cell size: " + str(cell_size))
@@ -35,58 +54,100 @@ class KDE:
         yscale = height / diff_lat  # pixels per lat
         xscale = width / diff_lon  # pixels per lon
 
+        if pool is not None and isinstance(all_trips, TrajectoryBatch):
+            themap, lines = self.draw_shared(all_trips, pool, workers, height, width, xscale, yscale)
+        else:
+            all_pixels = self.trip_pixels(all_trips, height, xscale, yscale)
+            themap = self.draw_histogram(all_pixels, height, width)
+            print("done.")
+            lines = self.draw_lines(all_pixels, height, width)
+
+        # save the lines
+        cv2.imwrite(raw_path, lines)
+
+        print("done.")
+        print("Smoothing... ")
+
+        blur = cv2.GaussianBlur(themap, (gaussian_blur, gaussian_blur), 0)
+        imageio.imwrite(kde_path, blur)
+
+        print("done.")
+        print("\nKDE generation complete.")
+
+    def draw_shared(self, all_trips, pool, workers, height, width, xscale, yscale):
+        # note: the batch is shared once and every worker draws a chunk of the trips into its own maps. the
+        #  histograms are summed with the same saturation as the serial drawing and the lines are combined.
+        shared_path = all_trips.share()
+        output_path = tempfile.mkdtemp(prefix='kde-', dir=SHARED_DIR)
+        try:
+            chunks = np.array_split(np.flatnonzero(all_trips.lengths >= 2), workers)
+            part_paths = list(pool.map(
+                partial(draw_trips, shared_path, height=height, width=width, xscale=xscale, yscale=yscale),
+                chunks, [os.path.join(output_path, str(chunk)) for chunk in range(len(chunks))]
+            ))
+            themap = np.zeros((height, width), np.uint16)
+            lines = np.zeros((height, width), np.uint8)
+            for part_path in part_paths:
+                cv2.add(themap, np.load(part_path + '-histogram.npy', mmap_mode='r'), themap)
+                np.maximum(lines, np.load(part_path + '-lines.npy', mmap_mode='r'), out=lines)
+        finally:
+            release_shared(shared_path)
+            shutil.rmtree(output_path, ignore_errors=True)
+        return themap, lines
+
+    def draw_histogram(self, all_pixels, height, width):
+
         themap = np.zeros((height, width), np.uint16)
 
         trip_counter = 1
 
-        for trip in all_trips:
+        for xs, ys in all_pixels:
 
-            if (trip_counter % 10 == 0) or (trip_counter == len(all_trips)):
-                print("\rCreating histogram (trip " + str(trip_counter) + "/" + str(len(all_trips)) + ")... ")
+            if (trip_counter % 10 == 0) or (trip_counter == len(all_pixels)):
+                print("\rCreating histogram (trip " + str(trip_counter) + "/" + str(len(all_pixels)) + ")... ")
             trip_counter += 1
             temp = np.zeros((height, width), np.uint8)
 
             limit = 400
-            for (orig, dest) in pairwise(trip.locations):
-                oy = height - int(yscale * (orig.latitude - min_lat))
-                ox = int(xscale * (orig.longitude - min_lon))
-                dy = height - int(yscale * (dest.latitude - min_lat))
-                dx = int(xscale * (dest.longitude - min_lon))
+            for (ox, dx), (oy, dy) in zip(pairwise(xs), pairwise(ys)):
                 cv2.line(temp, (ox, oy), (dx, dy), 32, 1)
 
             temp16 = np.uint16(temp)
             themap = cv2.add(themap, temp16, themap)
 
-        lines = np.zeros((height, width), np.uint8)
+        return themap
 
-        print("done.")
+    def draw_lines(self, all_pixels, height, width):
+
+        lines = np.zeros((height, width), np.uint8)
 
         trip_counter = 1
 
-        for trip in all_trips:
+        for xs, ys in all_pixels:
 
-            if (trip_counter % 10 == 0) or (trip_counter == len(all_trips)):
-                print("\rCreating drawing (trip " + str(trip_counter) + "/" + str(len(all_trips)) + ")... ")
+            if (trip_counter % 10 == 0) or (trip_counter == len(all_pixels)):
+                print("\rCreating drawing (trip " + str(trip_counter) + "/" + str(len(all_pixels)) + ")... ")
             trip_counter += 1
 
-            for orig, dest in pairwise(trip.locations):
-                oy = height - int(yscale * (orig.latitude - min_lat))
-                ox = int(xscale * (orig.longitude - min_lon))
-                dy = height - int(yscale * (dest.latitude - min_lat))
-                dx = int(xscale * (dest.longitude - min_lon))
+            for (ox, dx), (oy, dy) in zip(pairwise(xs), pairwise(ys)):
                 cv2.line(lines, (ox, oy), (dx, dy), 32, 1)
 
-        # save the lines
-        cv2.imwrite(raw_path, lines)
+        return lines
 
-        print("done.")
-        print("Smoothing... ")
 
-        blur = cv2.GaussianBlur(themap, (gaussian_blur, gaussian_blur), 0)
-        imageio.imwrite(kde_path, blur)
+def init_kde_worker(bounds):
+    global min_lat, min_lon
+    min_lat, min_lon = bounds
 
-        print("done.")
-        print("\nKDE generation complete.")
+
+def draw_trips(shared_path, positions, part_path, height, width, xscale, yscale):
+    # note: runs in a worker process attached to the shared batch. the maps of its trips are saved next to
+    #  the other parts instead of being pickled back
+    k = KDE()
+    all_pixels = k.trip_pixels(TrajectoryBatch.attach(shared_path)[positions], height, xscale, yscale)
+    np.save(part_path + '-histogram.npy', k.draw_histogram(all_pixels, height, width))
+    np.save(part_path + '-lines.npy', k.draw_lines(all_pixels, height, width))
+    return part_path
 
 
 if __name__ == '__main__':
@@ -94,9 +155,13 @@ if __name__ == '__main__':
     parser.add_argument('--cell_size', type=int, default=1, help='Cell size of each pixel in kde image (unit: meters)')
     parser.add_argument('--gaussian_blur', type=int, default=17, help='Gaussian kernel pixel size')
     parser.add_argument('--trajs_path', type=str, help='Path to gps trajectories')
+    parser.add_argument('--id_range', type=str, default='',
+                        help='Range of route ids to load when trajs_path is a trajectory store (first-last)')
     parser.add_argument('--bounding_box_path', type=str, help='Path to area bounding box')
     parser.add_argument('--kde_output_path', type=str, help='Path to save output kde image')
     parser.add_argument('--raw_output_path', type=str, help='Path to save raw trajectories output image')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes drawing the trajectories (needs trajectories in a batch)')
     args = parser.parse_args()
 
     cell_size = args.cell_size
@@ -112,4 +177,11 @@ if __name__ == '__main__':
         max_lat, min_lat, max_lon, min_lon = [float(line.strip('\n').split('=')[1]) for line in bbx_file]
 
     k = KDE()
-    k.create_kde_with_trips(TripLoader.load_all_trips(trips_path))
+    if args.workers > 1:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_kde_worker,
+                                 initargs=((min_lat, min_lon),)) as pool:
+            k.create_kde_with_trips(
+                TripLoader.load_batch(trips_path, parse_id_range(args.id_range)), pool, args.workers
+            )
+    else:
+        k.create_kde_with_trips(TripLoader.load_batch(trips_path, parse_id_range(args.id_range)))
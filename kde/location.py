@@ -1,5 +1,9 @@
-import os
+import os, sys
 import pandas as pd
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traj_store import is_store, TrajectoryBatch
 
 class Location:
     def __init__(self, id, latitude, longitude, time):
@@ -37,58 +41,68 @@ class Trip:
 class TripLoader:
     
     @staticmethod
-    def load_all_trips(trips_path):
-        
-        # storage for all trips
-        trajectories = []
-        
+    def load_all_trips(trips_path, id_range=None):
+
+        # trips are loaded as one columnar batch and turned into Trip objects
+        return TripLoader.trips_from_batch(TripLoader.load_batch(trips_path, id_range))
+
+    @staticmethod
+    def load_batch(trips_path, id_range=None):
+
+        # trips written to a trajectory store are loaded by columns and route id range
+        if is_store(trips_path):
+            return TrajectoryBatch.read(trips_path, ['latitude', 'longitude', 'timestamp'], id_range)
+
+        # storage for the trips of all files
+        batches = []
+
         # iterate through all trip filenames
-        # for trip_filename in os.listdir(trips_path):
         for dir_name in [x for x in os.listdir(trips_path) if os.path.isdir(os.path.join(trips_path, x)) and not x.startswith('.')]:
             file_names = sorted(os.listdir(os.path.join(trips_path, dir_name)))
 
-            # if filename starts with "trip_"
-            # if trip_filename.startswith("part-") is True:
             for file_name in file_names:
                 if not file_name.endswith('.csv'):
                     continue
 
-                # load trip from file
-                # new_trip = TripLoader.load_trip_from_file(trips_path + "/" + trip_filename)
-                modified_trips = TripLoader.load_trip_from_file(os.path.join(trips_path, dir_name, file_name))
-                trajectories += modified_trips
-        
+                # load trips from file
+                batches.append(TripLoader.load_batch_from_file(os.path.join(trips_path, dir_name, file_name)))
+
         # return all trips
-        return trajectories
-    
+        return TrajectoryBatch.concat(batches)
+
     @staticmethod
-    def load_trip_from_file(trip_filename):
+    def load_batch_from_file(trip_filename):
 
         # open trip file
         if os.path.exists(trip_filename) is not True:
             print('Path does not exists!')
             return
 
-        # create new trip object
-        new_trip = Trip()
-        temp_trips = pd.read_csv(trip_filename, sep=',', header=0, engine='python')
-        modified_trips = []
-        for i in range(len(temp_trips) - 1):
-            point = temp_trips.iloc[i]
-            new_trip.add_location(
-                Location(
-                    str(point['route_id']),
-                    float(point['latitude']),
-                    float(point['longitude']),
-                    str(point['timestamp'])
-                )
-            )
-            if point['route_id'] != temp_trips.iloc[i + 1]['route_id']:
-                if len(new_trip.locations) >= 2:
-                    modified_trips.append(new_trip)
+        temp_trips = pd.read_csv(trip_filename, sep=',', header=0, usecols=['route_id', 'latitude', 'longitude', 'timestamp'])
+        return TrajectoryBatch.from_points(temp_trips)
+
+    @staticmethod
+    def load_trip_from_file(trip_filename):
+
+        return TripLoader.trips_from_batch(TripLoader.load_batch_from_file(trip_filename))
+
+    @staticmethod
+    def trips_from_batch(batch):
+
+        # note: Trip objects of the routes with at least two locations, for the code that walks locations
+        locations = [
+            Location(str(route_id), latitude, longitude, timestamp) for route_id, latitude, longitude, timestamp
+            in zip(np.repeat(batch.route_ids, batch.lengths).tolist(), batch.latitudes.tolist(),
+                   batch.longitudes.tolist(), batch.timestamps.tolist())
+        ]
+        trajectories = []
+        for _, first, last in batch.routes():
+            if last - first >= 2:
                 new_trip = Trip()
+                new_trip.locations = locations[first:last]
+                trajectories.append(new_trip)
 
-        return modified_trips
+        return trajectories
 
 
 class TripWriter:
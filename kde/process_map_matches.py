@@ -1,7 +1,6 @@
 from streetmap import StreetMap
 from pylibs import spatialfunclib
 import sqlite3
-from datetime import datetime, timedelta
 import math
 
 pruning_rmse_threshold = 1000
@@ -162,15 +161,15 @@ class ProcessMapMatches:
         for record in matched_trip_records:
             if len(record) < 7:
                 _, obs_lat, obs_lon, obs_time, unknown_state = record
-                obs_time = datetime.strptime(obs_time[:19], '%Y-%m-%d %H:%M:%S')
+                obs_time = int(obs_time)
 
-                # observation blackout +/- 30 secconds of 'unknown' state observation time
+                # observation blackout +/- 30 secconds of 'unknown' state observation time (epoch ms)
                 no_obs_time_ranges.append(
-                    (obs_time - timedelta(seconds=int(30)), obs_time + timedelta(seconds=int(30))))
+                    (obs_time - 30 * 1000, obs_time + 30 * 1000))
 
             else:
                 _, obs_lat, obs_lon, obs_time, state_in_node_lat, state_in_node_lon, state_out_node_lat, state_out_node_lon = record
-                obs_time = datetime.strptime(obs_time[:19], '%Y-%m-%d %H:%M:%S')
+                obs_time = int(obs_time)
                 curr_state_edge = self.graphdb.edge_coords_lookup_table[
                     (float(state_in_node_lat), float(state_in_node_lon)), (
                     float(state_out_node_lat), float(state_out_node_lon))]
@@ -0,0 +1,348 @@
+import pandas as pd
+import numpy as np
+import argparse, json, os, queue, selectors, shutil, socket, subprocess, time
+from filtering import preprocess_arrays, decode_locations
+from epoch_time import to_epoch_ms, elapsed_seconds, epoch_to_datetime
+from traj_store import TrajectoryBatch
+
+# note: live records are json lines with the columns of the parquet dumps (a hex WKB location can replace
+#  longitude/latitude), read from a tailed file, a unix socket or a local queue. times of the stream (the
+#  largest record timestamp seen) drive the trip timeouts, the rolling window and the handoffs, so a replayed
+#  file gives the same trajectories as the live feed it was recorded from.
+RECORD_COLUMNS = ['device_id', 'route_slug', 'longitude', 'latitude', 'altitude', 'timestamp', 'bearing', 'speed']
+POINT_ATTRIBUTES = ['altitude', 'bearing', 'speed']
+POLL_INTERVAL = 1.0 # seconds
+READ_SIZE = 1 << 20 # bytes
+
+
+def parse_records(lines):
+    # note: json lines (or already parsed dicts) to a records frame, malformed lines and records without a
+    #  device, a time or a position are skipped
+    records = []
+    for line in lines:
+        if isinstance(line, dict):
+            records.append(line)
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            print('Skipping malformed record: ' + line[:80])
+    records_df = pd.DataFrame.from_records(records)
+    for column_name in RECORD_COLUMNS:
+        if column_name not in records_df:
+            records_df[column_name] = np.nan
+    if 'location' in records_df:
+        encoded = records_df.longitude.isna() & records_df.location.notna()
+        if encoded.any():
+            longitudes, latitudes = decode_locations(records_df.location[encoded])
+            records_df.loc[encoded, 'longitude'] = longitudes
+            records_df.loc[encoded, 'latitude'] = latitudes
+    records_df = records_df[RECORD_COLUMNS].dropna(subset=['device_id', 'timestamp', 'longitude', 'latitude'])
+    records_df['route_slug'] = records_df.route_slug.fillna('')
+    records_df['timestamp'] = to_epoch_ms(records_df.timestamp)
+    records_df[['longitude', 'latitude'] + POINT_ATTRIBUTES] = records_df[
+        ['longitude', 'latitude'] + POINT_ATTRIBUTES
+    ].astype(np.float64)
+    return records_df
+
+
+def tail_lines(file_path, poll_interval=POLL_INTERVAL, follow=True):
+    # note: yields the complete lines appended to the file since the last poll (an empty list when nothing
+    #  was appended), a partial last line waits for the rest of it. without follow it stops at the end.
+    with open(file_path, 'r') as stream:
+        pending = ''
+        while True:
+            chunk = stream.read(READ_SIZE)
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            yield [line for line in lines if line.strip()]
+            if len(chunk) == READ_SIZE:
+                continue
+            if not follow:
+                if pending.strip():
+                    yield [pending]
+                return
+            time.sleep(poll_interval)
+
+
+def socket_lines(socket_path, poll_interval=POLL_INTERVAL):
+    # note: listens on a unix stream socket, any number of writers can connect and send json lines. yields
+    #  the lines received in every poll interval.
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    pending = {}
+    try:
+        while True:
+            lines = []
+            for key, _ in selector.select(timeout=poll_interval):
+                if key.fileobj is server:
+                    connection, _ = server.accept()
+                    connection.setblocking(False)
+                    selector.register(connection, selectors.EVENT_READ)
+                    pending[connection] = b''
+                    continue
+                connection = key.fileobj
+                data = connection.recv(READ_SIZE)
+                if not data:
+                    selector.unregister(connection)
+                    connection.close()
+                    data = pending.pop(connection) + b'\n'
+                else:
+                    data = pending[connection] + data
+                parts = data.split(b'\n')
+                if connection in pending:
+                    pending[connection] = parts.pop()
+                lines += [part.decode() for part in parts if part.strip()]
+            yield lines
+    finally:
+        for connection in pending:
+            connection.close()
+        selector.close()
+        server.close()
+        os.remove(socket_path)
+
+
+def queue_lines(record_queue, poll_interval=POLL_INTERVAL):
+    # note: local queue stand-in of a message broker, items are json lines or record dicts and None ends
+    #  the stream
+    while True:
+        lines = []
+        try:
+            item = record_queue.get(timeout=poll_interval)
+            while item is not None:
+                lines.append(item)
+                item = record_queue.get_nowait()
+            yield lines
+            return
+        except queue.Empty:
+            pass
+        yield lines
+
+
+class LiveWindow:
+    # note: every device has one open trip. a route_slug change, a point out of the boundary or a time step
+    #  over time_threshold finishes it, and so does the stream passing time_threshold after its last point.
+    #  finished trips are filtered together by preprocess_arrays (the preprocess filters) and the resulting
+    #  trajectories stay in the window until their last point is window_hours older than the stream.
+    def __init__(self, boundary, output_dir, window_hours=6, handoff_interval=600, handoff_commands=(), **kwargs):
+        self.boundary = boundary
+        self.output_dir = output_dir
+        self.window_ms = int(window_hours * 3600 * 1000)
+        self.handoff_ms = int(handoff_interval * 1000)
+        self.handoff_commands = list(handoff_commands)
+        self.preprocess_kwargs = kwargs
+        self.time_threshold = kwargs['time_threshold'] if 'time_threshold' in kwargs else 20
+        self.open_trips = {}
+        self.finished = []
+        self.window = TrajectoryBatch(
+            np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64), np.zeros(0), np.zeros(0),
+            np.zeros(0, dtype=np.int64), {column_name: np.zeros(0) for column_name in POINT_ATTRIBUTES}
+        )
+        self.next_route_id = 0
+        self.clock = None
+        self.last_handoff = None
+        self.handoff_process = None
+
+    def add(self, records_df):
+        if len(records_df) == 0:
+            return
+        records_df = records_df.sort_values(by=['device_id', 'timestamp'], kind='stable')
+        latest = int(records_df.timestamp.max())
+        self.clock = latest if self.clock is None else max(self.clock, latest)
+        for device_id, device_df in records_df.groupby('device_id', sort=False):
+            self.add_device(device_id, device_df)
+
+    def add_device(self, device_id, device_df):
+        trip = self.open_trips.get(device_id)
+        if trip is not None:
+            # note: late and repeated records of a device are dropped
+            device_df = device_df[device_df.timestamp.to_numpy() > trip['last_time']]
+            if len(device_df) == 0:
+                return
+        times = device_df.timestamp.to_numpy()
+        route_slugs = device_df.route_slug.to_numpy()
+        longitudes, latitudes = device_df.longitude.to_numpy(), device_df.latitude.to_numpy()
+        in_bound = (
+            (self.boundary['west'] < longitudes) & (longitudes < self.boundary['east']) &
+            (self.boundary['south'] < latitudes) & (latitudes < self.boundary['north'])
+        )
+        starts = np.ones(len(device_df), dtype=bool)
+        starts[1:] = (
+            (route_slugs[1:] != route_slugs[:-1]) |
+            (elapsed_seconds(times[1:], times[:-1]) > self.time_threshold) |
+            ~in_bound[:-1]
+        )
+        if trip is not None:
+            starts[0] = (
+                route_slugs[0] != trip['route_slug'] or
+                elapsed_seconds(times[0], trip['last_time']) > self.time_threshold or
+                not trip['in_bound']
+            )
+        segment_ids = np.cumsum(starts)
+        for segment_id in np.unique(segment_ids).tolist():
+            if segment_id > 0 or trip is None:
+                self.finish_trip(device_id)
+                trip = self.open_trips[device_id] = dict(parts=[])
+            segment = segment_ids == segment_id
+            trip['parts'].append(device_df[segment & in_bound])
+            last = np.flatnonzero(segment)[-1]
+            trip['route_slug'], trip['last_time'], trip['in_bound'] = route_slugs[last], times[last], in_bound[last]
+
+    def finish_trip(self, device_id):
+        trip = self.open_trips.pop(device_id, None)
+        if trip is None:
+            return
+        points_df = pd.concat(trip['parts'], ignore_index=True) if trip['parts'] else None
+        if points_df is not None and len(points_df) > 1:
+            self.finished.append(points_df)
+
+    def finish_idle(self):
+        # note: a trip whose next point would break it on time is finished as soon as the stream passes it
+        idle = [
+            device_id for device_id, trip in self.open_trips.items()
+            if elapsed_seconds(self.clock, trip['last_time']) > self.time_threshold
+        ]
+        for device_id in idle:
+            self.finish_trip(device_id)
+
+    def filter_finished(self):
+        # note: all the trips finished since the last poll are filtered at once
+        points_df = pd.concat(self.finished, ignore_index=True)
+        lengths = [len(trip_df) for trip_df in self.finished]
+        self.finished = []
+        kept, offsets = preprocess_arrays(
+            points_df.longitude.to_numpy(), points_df.latitude.to_numpy(), points_df.timestamp.to_numpy(),
+            np.concatenate([[0], np.cumsum(lengths)]), **self.preprocess_kwargs
+        )
+        lengths = np.diff(offsets)
+        kept = kept[np.repeat(lengths > 1, lengths)]
+        lengths = lengths[lengths > 1]
+        trajectories = TrajectoryBatch(
+            self.next_route_id + np.arange(len(lengths)),
+            np.concatenate([[0], np.cumsum(lengths)]),
+            points_df.longitude.to_numpy()[kept],
+            points_df.latitude.to_numpy()[kept],
+            points_df.timestamp.to_numpy()[kept],
+            {column_name: points_df[column_name].to_numpy()[kept] for column_name in POINT_ATTRIBUTES}
+        )
+        self.next_route_id += len(trajectories)
+        return trajectories
+
+    def tick(self, flush=False):
+        # note: called after every poll. finishes idle trips (all trips with flush), moves the new
+        #  trajectories to the window, drops the expired ones and hands the window over when it is due.
+        if self.clock is None:
+            return
+        if flush:
+            for device_id in list(self.open_trips):
+                self.finish_trip(device_id)
+        else:
+            self.finish_idle()
+        if self.finished:
+            self.window = TrajectoryBatch.concat([self.window, self.filter_finished()])
+        if len(self.window):
+            last_times = self.window.timestamps[self.window.offsets[1:] - 1]
+            expired = last_times < self.clock - self.window_ms
+            if expired.any():
+                self.window = self.window[~expired]
+        if self.last_handoff is None:
+            self.last_handoff = self.clock
+        if flush or self.clock - self.last_handoff >= self.handoff_ms:
+            self.handoff()
+
+    def handoff(self):
+        # note: the window is written as a trajectory store snapshot and the handoff commands (e.g. kde.py
+        #  and graphdb_matcher_run.py with --trajs_path {trajs_path}) run on it in the background. a handoff
+        #  is skipped while the commands of the previous one are still running.
+        if self.handoff_process is not None and self.handoff_process.poll() is None:
+            print('Previous handoff is still running, skipping this one')
+            return
+        self.last_handoff = self.clock
+        print(f'{epoch_to_datetime(self.clock)}: {len(self.window)} trajectories, '
+              f'{len(self.open_trips)} open trips')
+        if len(self.window) == 0:
+            return
+        trajs_path = os.path.join(self.output_dir, 'window')
+        temp_path = trajs_path + '.tmp'
+        shutil.rmtree(temp_path, ignore_errors=True)
+        self.window.write(temp_path)
+        shutil.rmtree(trajs_path, ignore_errors=True)
+        os.rename(temp_path, trajs_path)
+        if self.handoff_commands:
+            self.handoff_process = subprocess.Popen(
+                ' && '.join(command.format(trajs_path=trajs_path) for command in self.handoff_commands), shell=True
+            )
+
+    def wait(self):
+        if self.handoff_process is not None:
+            self.handoff_process.wait()
+
+
+def run_live(line_batches, live_window):
+    # note: consumes the polls of a source until it ends or is interrupted, then finishes all the trips
+    #  and hands the last window over
+    try:
+        for lines in line_batches:
+            if lines:
+                live_window.add(parse_records(lines))
+            live_window.tick()
+    except KeyboardInterrupt:
+        print('Stopping live ingestion')
+    live_window.tick(flush=True)
+    live_window.wait()
+    return live_window.window
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Live ingestion of GPS records into a rolling window of trajectories')
+    parser.add_argument('--source', type=str, default='file', choices=['file', 'socket'],
+                        help='read json lines appended to a file or sent to a unix socket (default: file)')
+    parser.add_argument('--source_path', type=str, help='Path to the tailed file or the unix socket')
+    parser.add_argument('--no_follow', action='store_true', default=False,
+                        help='stop at the end of the file instead of waiting for new records (replay)')
+    parser.add_argument('--bounding_box_path', type=str, help='Path to area bounding box')
+    parser.add_argument('--output_directory', type=str, help='Directory to save the window snapshots (window/)')
+    parser.add_argument('--window_hours', type=float, default=6,
+                        help='hours of finished trajectories kept in the window (default: 6)')
+    parser.add_argument('--handoff_interval', type=float, default=600,
+                        help='seconds between two handoffs of the window (default: 600)')
+    parser.add_argument('--handoff_command', type=str, action='append', default=[],
+                        help='command run on every window snapshot, {trajs_path} is replaced by the snapshot path. '
+                             'can be repeated, e.g. kde.py and then graphdb_matcher_run.py')
+    parser.add_argument('--poll_interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between two polls of the source (default: 1)')
+    parser.add_argument('--time_threshold', type=float, default=20,
+                        help='time step (seconds) that finishes a trip (default: 20)')
+    parser.add_argument('--min_dist_threshold', type=float, default=5, help='(default: 5 meters)')
+    parser.add_argument('--max_dist_threshold', type=float, default=170, help='(default: 170 meters)')
+    parser.add_argument('--min_spd_threshold', type=float, default=2, help='(default: 2 m/s)')
+    parser.add_argument('--max_spd_threshold', type=float, default=26, help='(default: 26 m/s)')
+    args = parser.parse_args()
+
+    with open(args.bounding_box_path, 'r') as bbx_file:
+        north, south, east, west = [float(line.strip('\n').split('=')[1]) for line in bbx_file]
+
+    os.makedirs(args.output_directory, exist_ok=True)
+    live_window = LiveWindow(
+        boundary=dict(east=east, west=west, north=north, south=south),
+        output_dir=args.output_directory,
+        window_hours=args.window_hours,
+        handoff_interval=args.handoff_interval,
+        handoff_commands=args.handoff_command,
+        time_threshold=args.time_threshold,
+        min_dist_threshold=args.min_dist_threshold,
+        max_dist_threshold=args.max_dist_threshold,
+        min_spd_threshold=args.min_spd_threshold,
+        max_spd_threshold=args.max_spd_threshold
+    )
+    if args.source == 'socket':
+        line_batches = socket_lines(args.source_path, args.poll_interval)
+    else:
+        line_batches = tail_lines(args.source_path, args.poll_interval, follow=not args.no_follow)
+    run_live(line_batches, live_window)
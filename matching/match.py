@@ -19,10 +19,12 @@ for example to install on ubuntu os you should follow the steps bellow:
 """
 
 from fmm import GPSConfig, ResultConfig, Network, NetworkGraph, STMATCH, STMATCHConfig
-import argparse, os
+import argparse, os, sys
 import pandas as pd
 import geopandas as gp
 import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from traj_store import is_store, store_to_shapefile, parse_id_range
 
 METERS_PER_DEGREE_LATITUDE = 111120
 METERS_PER_DEGREE_LONGITUDE = 90329
@@ -87,7 +89,17 @@ if __name__ == '__main__':
                         help='Portion of the trajectory which should overlap with existing edge')
     parser.add_argument('--save_unmatched', type=bool, default=False,
                         help='Flag to save unmatched results or not only available if add_score is True')
+    parser.add_argument('--id_range', type=str, default='',
+                        help='Range of route ids to match when trajs_path is a trajectory store (first-last)')
     args = parser.parse_args()
+
+    if is_store(args.trajs_path):
+        # note: fmm reads shape files, trajectories of a trajectory store are converted first
+        args.trajs_path = store_to_shapefile(
+            args.trajs_path,
+            os.path.join(os.path.normpath(args.trajs_path) + '-shape', 'trajs.shp'),
+            parse_id_range(args.id_range)
+        )
     print(args.ground_map_path, args.trajs_path, args.output_file_path)
 
     config = STMATCHConfig()
@@ -1,4 +1,4 @@
-from evaluation_utils import traj_partition
+from evaluation_utils import traj_partition_tiles
 import pandas as pd
 import geopandas as gp
 import matplotlib.pyplot as plt
@@ -52,6 +52,14 @@ results, errors = execute('python ground-map/ground_map.py --bounding_box_path .
 print(errors)
 results, errors = execute('python matching/match.py --ground_map_path ./ground-map/map/all_edges.shp --trajs_path ./data/trajectories/trajs.shp --output_file_path ./data/trajs_mr.csv --write_opath True --radius 100 --gps_error 40')
 print(errors)
+# note: all the tiles are partitioned in a single pass over the trajectories
+tile_boundaries = [
+    dict(east=horz_bound[1], west=horz_bound[0], north=vert_bound[1], south=vert_bound[0])
+    for vert_bound in vert_bounds for horz_bound in horz_bounds
+]
+split_threshold = 50000
+trajs_dirpath = './data/gps-csv/sample-area/'
+_ = traj_partition_tiles(trajs_dirpath, tile_boundaries, './data/gps-csv/', split_threshold)
 for vert_bound in vert_bounds:
     for horz_bound in horz_bounds:
         boundary = dict(
@@ -69,10 +77,7 @@ for vert_bound in vert_bounds:
             f'EAST_LONGITUDE={boundary["east"]}\n'+\
             f'WEST_LONGITUDE={boundary["west"]}'
             bound_file.write(txt2write)
-        split_threshold = 50000
-        trajs_dirpath = './data/gps-csv/sample-area/'
         csv_dirpath = './data/gps-csv/'
-        _ = traj_partition(trajs_dirpath, boundary, csv_dirpath, split_threshold)
         groundmap_dir = os.path.join('./ground-map/map/', output_dir)
         csv_dirpath = os.path.join(csv_dirpath, output_dir)
         results_path = os.path.join('./results/kde/', output_dir)
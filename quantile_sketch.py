@@ -0,0 +1,87 @@
+import numpy as np
+
+# note: mergeable streaming quantile sketch with logarithmic buckets (DDSketch). a value x > MIN_VALUE is
+#  counted in bucket ceil(log_gamma(x)), bucket bounds grow by gamma = (1 + a) / (1 - a), so every quantile
+#  is estimated within the relative accuracy a. merging adds the bucket counts, sketches of batches merged
+#  in any order and in any process are exactly the sketch of one pass over all the values.
+RELATIVE_ACCURACY = 0.01
+# note: smaller values (zero time steps, standing devices) are counted in the zero bucket
+MIN_VALUE = 1e-3
+
+
+class QuantileSketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        # note: counts an array of values at once, nan and infinite values are ignored
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        positive = values[values > MIN_VALUE]
+        self.zero_count += len(values) - len(positive)
+        indices, counts = np.unique(np.ceil(np.log(positive) / np.log(self.gamma)).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Sketches with different relative accuracies can not be merged!')
+        self.count += other.count
+        self.zero_count += other.zero_count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        return self
+
+    def quantiles(self, qs):
+        # note: the value of rank q * (count - 1) for every q, nan for an empty sketch
+        if self.count == 0:
+            return [np.nan for _ in qs]
+        indices = np.array(sorted(self.buckets), dtype=np.int64)
+        cumulative = self.zero_count + np.cumsum([self.buckets[index] for index in indices.tolist()])
+        values = 2 * self.gamma ** indices / (self.gamma + 1)
+        results = []
+        for q in qs:
+            rank = q * (self.count - 1)
+            if rank < self.zero_count:
+                results.append(self.min)
+                continue
+            value = values[min(np.searchsorted(cumulative, rank, side='right'), len(values) - 1)]
+            results.append(float(np.clip(value, self.min, self.max)))
+        return results
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def to_dict(self):
+        return dict(
+            relative_accuracy=self.relative_accuracy,
+            count=self.count,
+            zero_count=self.zero_count,
+            min=self.min if self.count else None,
+            max=self.max if self.count else None,
+            buckets={str(index): count for index, count in sorted(self.buckets.items())}
+        )
+
+    @staticmethod
+    def from_dict(values):
+        sketch = QuantileSketch(values['relative_accuracy'])
+        sketch.count = values['count']
+        sketch.zero_count = values['zero_count']
+        if sketch.count:
+            sketch.min, sketch.max = values['min'], values['max']
+        sketch.buckets = {int(index): count for index, count in values['buckets'].items()}
+        return sketch
@@ -1,4 +1,4 @@
-from filtering import load_data, trajToShape, load_directory, datsetToUTM
+from filtering import load_data, trajToShape, load_directory, datsetToUTM, parse_filter_stages
 import argparse
 import os
 
@@ -13,8 +13,52 @@ if __name__ == '__main__':
                         help='if parquet files are large size. (default: False)')
     parser.add_argument('--has_distance', type=bool, default=False,
                         help='if parquet files has column. (default: False)')
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'parquet'],
+                        help='csv chunks and shape files or a trajectory store (parquet) at csv_output_directory, '
+                             'only used with --from_directory (default: csv)')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='only load new or changed parquet files and append them to the trajectory store, '
+                             'one file at a time so route ids of unchanged files stay the same, '
+                             'needs --output_format parquet')
+    parser.add_argument('--memory-budget', type=str, default=None,
+                        help='memory budget of the loading (e.g. 16G), picks the number of files loaded at once '
+                             'and stores records with compact dtypes')
+    parser.add_argument('--filter_stages', type=str, default=None,
+                        help='filter stages of the loading in order with their thresholds, e.g. '
+                             '"duplicate_time=0,min_distance=5,time_gap=10,speed_jump=25,distance_jump=100,min_length=2" '
+                             '(stages: duplicate_time, min_distance, time_gap, speed_jump, distance_jump, min_length, simplify, stay_points)')
+    parser.add_argument('--simplify_tolerance', type=float, default=None,
+                        help='simplify trajectories within this tolerance (meters) keeping the timestamps of '
+                             'the retained points (default: no simplification)')
+    parser.add_argument('--stay_radius', type=float, default=None,
+                        help='collapse stay points (dwells within this radius in meters) into one point with '
+                             'a duration column (default: no stay point detection)')
+    parser.add_argument('--stay_duration', type=float, default=120,
+                        help='minimum duration of a stay point in seconds (default: 120)')
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='drop repeated (device_id, timestamp) records of overlapping parquet files')
+    parser.add_argument('--start_time', type=str, default='',
+                        help='start of the time window, e.g. "2021-06-06" or "2021-06-06 08:00:00". day partitions '
+                             '(<data_directory>/<day>) before it are not read (default: no start, --from_directory '
+                             'used to load 2021-06-06 to 2021-06-09 only, pass --start_time 2021-06-06 '
+                             '--end_time 2021-06-09 for that window)')
+    parser.add_argument('--end_time', type=str, default='',
+                        help='end of the time window, a bare day includes the whole day. day partitions after it '
+                             'are not read (default: no end, see --start_time)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to read and filter parquet files in parallel (default: 1)')
+    parser.add_argument('--external_sort', action='store_true', default=False,
+                        help='sort all points by route through sorted runs on disk, so no route is split between '
+                             'batches of large size files')
+    parser.add_argument('--spill_dir', type=str, default=None,
+                        help='directory of the sorted runs of --external_sort (default: next to the csv output '
+                             'directory)')
     parser.add_argument('-utm', '--convert-to-utm', action='store_true', default=False)
     parser.add_argument('--utm-out-dir', type=str, help='path to save output csv files in utm coordinates')
+    parser.add_argument('--utm-zone', type=int, default=None,
+                        help='UTM zone of the conversion (default: picked from the bounding box)')
+    parser.add_argument('--utm-format', type=str, default='csv', choices=['csv', 'parquet'],
+                        help='write the utm coordinates as csv files or as a trajectory store (default: csv)')
     args = parser.parse_args()
 
     with open(args.bounding_box_path, 'r') as bbx_file:
@@ -42,11 +86,27 @@ if __name__ == '__main__':
             shape_path=args.shape_output_directory,
             has_distance=has_distance,
             large_size=large_size_files,
-            start_time='2021-06-06 00:00:00',
-            end_time='2021-06-09 23:59:59'
+            start_time=args.start_time,
+            end_time=args.end_time,
+            output_format=args.output_format,
+            workers=args.workers,
+            incremental=args.incremental,
+            memory_budget=args.memory_budget,
+            filter_stages=parse_filter_stages(args.filter_stages) if args.filter_stages else None,
+            simplify_tolerance=args.simplify_tolerance,
+            stay_radius=args.stay_radius,
+            stay_duration=args.stay_duration,
+            dedup=args.dedup,
+            external_sort=args.external_sort,
+            spill_dir=args.spill_dir
         )
     else:
-        csvfiles_dir = load_data(args.data_directory, boundary, args.csv_output_directory)
+        csvfiles_dir = load_data(
+            args.data_directory, boundary, args.csv_output_directory,
+            workers=args.workers,
+            start_time=args.start_time,
+            end_time=args.end_time
+        )
         traj_directory = '/'.join(args.shape_output_directory.split('/')[:-1])
         if not os.path.exists(traj_directory):
             os.makedirs(traj_directory)
@@ -54,4 +114,10 @@ if __name__ == '__main__':
         # trajToShape('./data/gps-csv/sample-area/', args.shape_output_directory)
 
     if args.convert_to_utm:
-        datsetToUTM(args.csv_output_directory, args.utm_out_dir)
\ No newline at end of file
+        datsetToUTM(
+            args.csv_output_directory, args.utm_out_dir,
+            boundary=boundary,
+            zone=args.utm_zone,
+            workers=args.workers,
+            output_format=args.utm_format
+        )
\ No newline at end of file
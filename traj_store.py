@@ -0,0 +1,468 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import geopandas as gp
+from shapely import wkb
+import argparse, json, os, shutil, tempfile
+from epoch_time import to_epoch_ms
+
+# note: the trajectory store is a directory of GeoParquet files, one file per written batch named
+#  <first route id>-<last route id>.parquet. each row is one trajectory: its route id, a WKB LineString
+#  geometry and one list column per point attribute. rows are sorted by route id and every row group holds
+#  a contiguous id range, so readers can skip files and row groups by the id statistics and read only the
+#  columns they need.
+ROUTES_PER_GROUP = 10000
+POINT_COLUMNS = ['longitude', 'latitude', 'altitude', 'timestamp', 'bearing', 'speed']
+ATTRIBUTE_TYPES = {
+    'altitude': pa.float64(),
+    'timestamp': pa.int64(),
+    'bearing': pa.float64(),
+    'speed': pa.float64()
+}
+# note: optional point attributes, written when the points frame has them (stay durations in ms)
+OPTIONAL_ATTRIBUTE_TYPES = {
+    'duration': pa.int64()
+}
+WKB_HEADER_SIZE = 9
+# note: arrow binary and list arrays have int32 offsets, the trajectories of a table are split in chunks of
+#  at most this many WKB bytes (a chunk has even fewer points, 16 bytes each)
+MAX_CHUNK_BYTES = (1 << 31) - 1
+# note: shared batches are published as .npy files that worker processes memory-map read-only. a RAM-backed
+#  directory keeps them off the disk where there is one.
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+SHARED_ARRAYS = ['route_ids', 'offsets', 'longitudes', 'latitudes', 'timestamps']
+
+
+def is_store(path):
+    return os.path.isdir(path) and any(file_name.endswith('.parquet') for file_name in os.listdir(path))
+
+
+def parse_id_range(id_range):
+    # note: parses an id range given as "first-last" (both ends inclusive, either end may be empty)
+    if not id_range:
+        return None
+    first, last = id_range.split('-')
+    return int(first) if first else None, int(last) if last else None
+
+
+def route_offsets(route_ids):
+    route_ids = np.asarray(route_ids)
+    if len(route_ids) == 0:
+        return np.zeros(1, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], route_ids[1:] != route_ids[:-1]]))
+    return np.concatenate([starts, [len(route_ids)]])
+
+
+def header_positions(byte_offsets):
+    return (byte_offsets[:-1, None] + np.arange(WKB_HEADER_SIZE)).ravel()
+
+
+def encode_linestrings(longitudes, latitudes, offsets):
+    # note: builds little-endian WKB LineStrings for all the trajectories at once from the coordinate
+    #  arrays and the trajectory offsets. returns the WKB bytes and the byte offsets of the geometries.
+    lengths = np.diff(offsets)
+    byte_offsets = np.concatenate([[0], np.cumsum(WKB_HEADER_SIZE + 16 * lengths)])
+    headers = np.zeros((len(lengths), WKB_HEADER_SIZE), dtype=np.uint8)
+    headers[:, 0] = 1
+    headers[:, 1:5] = np.array([2], dtype='<u4').view(np.uint8)
+    headers[:, 5:9] = lengths.astype('<u4').view(np.uint8).reshape(-1, 4)
+    coords = np.column_stack([longitudes, latitudes]).astype('<f8')
+    buffer = np.empty(byte_offsets[-1], dtype=np.uint8)
+    is_header = np.zeros(byte_offsets[-1], dtype=bool)
+    is_header[header_positions(byte_offsets)] = True
+    buffer[is_header] = headers.ravel()
+    buffer[~is_header] = coords.view(np.uint8).ravel()
+    return buffer, byte_offsets
+
+
+def chunk_ranges(byte_offsets, max_bytes=MAX_CHUNK_BYTES):
+    # note: consecutive (first, last) trajectory ranges whose WKB bytes fit in max_bytes
+    ranges = []
+    first, n_routes = 0, len(byte_offsets) - 1
+    while first < n_routes:
+        last = max(int(np.searchsorted(byte_offsets, byte_offsets[first] + max_bytes, side='right')) - 1, first + 1)
+        if byte_offsets[last] - byte_offsets[first] > max_bytes:
+            raise ValueError(f'Trajectory {first} of the table is larger than {max_bytes} WKB bytes!')
+        ranges.append((first, last))
+        first = last
+    return ranges or [(0, 0)]
+
+
+def decode_linestrings(geometries):
+    # note: inverse of encode_linestrings on an arrow binary (or large binary) column, returns longitudes,
+    #  latitudes and the trajectory offsets without creating a geometry object per trajectory. chunks are
+    #  decoded one by one, a column larger than the int32 offsets of a single binary array is never combined
+    chunks = geometries.chunks if isinstance(geometries, pa.ChunkedArray) else [geometries]
+    longitudes, latitudes, lengths = [], [], []
+    for chunk in chunks:
+        if chunk.type not in (pa.binary(), pa.large_binary()):
+            chunk = chunk.cast(pa.large_binary())
+        offset_type = np.int64 if chunk.type == pa.large_binary() else np.int32
+        _, offsets_buffer, data_buffer = chunk.buffers()
+        byte_offsets = np.frombuffer(offsets_buffer, dtype=offset_type)[chunk.offset:chunk.offset + len(chunk) + 1]
+        buffer = np.frombuffer(data_buffer, dtype=np.uint8)[byte_offsets[0]:byte_offsets[-1]] \
+            if data_buffer is not None else np.empty(0, dtype=np.uint8)
+        byte_offsets = byte_offsets.astype(np.int64) - byte_offsets[0]
+        headers = buffer[header_positions(byte_offsets)].reshape(-1, WKB_HEADER_SIZE)
+        lengths.append(np.ascontiguousarray(headers[:, 5:9]).view('<u4').ravel().astype(np.int64))
+        is_header = np.zeros(len(buffer), dtype=bool)
+        is_header[header_positions(byte_offsets)] = True
+        coords = np.ascontiguousarray(buffer[~is_header]).view('<f8').reshape(-1, 2)
+        longitudes.append(coords[:, 0])
+        latitudes.append(coords[:, 1])
+    if not chunks:
+        return np.zeros(0), np.zeros(0), np.zeros(1, dtype=np.int64)
+    return np.concatenate(longitudes), np.concatenate(latitudes), \
+        np.concatenate([[0], np.cumsum(np.concatenate(lengths))]).astype(np.int64)
+
+
+def trajectories_table(points_df, crs=None):
+    # note: groups a route sorted points frame (route_id and point columns) into one row per trajectory.
+    #  coordinates are WGS84 longitude/latitude unless another crs (e.g. 'EPSG:32639') is given.
+    offsets = route_offsets(points_df.route_id.to_numpy())
+    buffer, byte_offsets = encode_linestrings(
+        points_df.longitude.to_numpy(), points_df.latitude.to_numpy(), offsets
+    )
+    chunks = chunk_ranges(byte_offsets)
+    geometries = pa.chunked_array([
+        pa.Array.from_buffers(pa.binary(), last - first, [
+            None,
+            pa.py_buffer((byte_offsets[first:last + 1] - byte_offsets[first]).astype(np.int32)),
+            pa.py_buffer(buffer[byte_offsets[first]:byte_offsets[last]])
+        ]) for first, last in chunks
+    ], type=pa.binary())
+    route_ids = points_df.route_id.to_numpy()[offsets[:-1]].astype(np.int64)
+    columns = {
+        'id': pa.chunked_array([pa.array(route_ids[first:last]) for first, last in chunks], type=pa.int64()),
+        'geometry': geometries
+    }
+    attribute_types = dict(ATTRIBUTE_TYPES)
+    attribute_types.update({
+        column_name: column_type for column_name, column_type in OPTIONAL_ATTRIBUTE_TYPES.items()
+        if column_name in points_df
+    })
+    for column_name, column_type in attribute_types.items():
+        values = points_df[column_name].to_numpy()
+        if column_name == 'timestamp':
+            values = to_epoch_ms(points_df[column_name])
+        columns[column_name] = pa.chunked_array([
+            pa.ListArray.from_arrays(
+                pa.array((offsets[first:last + 1] - offsets[first]).astype(np.int32)),
+                pa.array(values[offsets[first]:offsets[last]], type=column_type)
+            ) for first, last in chunks
+        ], type=pa.list_(column_type))
+    table = pa.table(columns)
+    geo_metadata = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': ['LineString'],
+                'bbox': [
+                    float(points_df.longitude.min()), float(points_df.latitude.min()),
+                    float(points_df.longitude.max()), float(points_df.latitude.max())
+                ] if len(points_df) else []
+            }
+        }
+    }
+    if crs is not None:
+        from pyproj import CRS
+        geo_metadata['columns']['geometry']['crs'] = CRS(crs).to_json_dict()
+    return table.replace_schema_metadata({'geo': json.dumps(geo_metadata)})
+
+
+def write_trajectories(points_df, store_path, routes_per_group=ROUTES_PER_GROUP, crs=None):
+    if len(points_df) == 0:
+        return None
+    points_df = points_df.sort_values(by='route_id', kind='stable')
+    # note: a LineString needs at least 2 points, shorter routes (e.g. left by a filter after the
+    #  trajectories were built) are not stored
+    lengths = np.diff(route_offsets(points_df.route_id.to_numpy()))
+    if (lengths < 2).any():
+        print(f'{int((lengths < 2).sum())} routes with less than 2 points are not stored')
+        points_df = points_df[np.repeat(lengths >= 2, lengths)]
+        if len(points_df) == 0:
+            return None
+    os.makedirs(store_path, exist_ok=True)
+    table = trajectories_table(points_df, crs)
+    route_ids = points_df.route_id.to_numpy()
+    file_name = os.path.join(store_path, f'{route_ids.min()}-{route_ids.max()}.parquet')
+    pq.write_table(table, file_name, row_group_size=routes_per_group)
+    return file_name
+
+
+def id_filter(id_range):
+    if id_range is None:
+        return None
+    first, last = id_range
+    expression = None
+    if first is not None:
+        expression = ds.field('id') >= first
+    if last is not None:
+        expression = ds.field('id') <= last if expression is None else expression & (ds.field('id') <= last)
+    return expression
+
+
+def store_files(store_path, id_range=None):
+    # note: store files whose id range (from the file name) overlaps the requested range
+    if os.path.isfile(store_path):
+        return [store_path]
+    file_paths = []
+    for file_name in os.listdir(store_path):
+        if not file_name.endswith('.parquet'):
+            continue
+        first_id, last_id = [int(x) for x in file_name[:-len('.parquet')].split('-')]
+        if id_range is not None:
+            if id_range[0] is not None and last_id < id_range[0]:
+                continue
+            if id_range[1] is not None and first_id > id_range[1]:
+                continue
+        file_paths.append((first_id, os.path.join(store_path, file_name)))
+    return [file_path for _, file_path in sorted(file_paths)]
+
+
+def read_trajectories(store_path, columns=None, id_range=None):
+    # note: one row per trajectory, only the requested columns (id is always read) of the
+    #  files and row groups that overlap id_range are loaded
+    file_paths = store_files(store_path, id_range)
+    if columns is not None:
+        columns = ['id'] + [column_name for column_name in columns if column_name != 'id']
+    if not file_paths:
+        return pa.table({'id': pa.array([], type=pa.int64())})
+    dataset = ds.dataset(file_paths, format='parquet')
+    table = dataset.to_table(columns=columns, filter=id_filter(id_range))
+    return table.take(pa.array(np.argsort(table.column('id').to_numpy(), kind='stable')))
+
+
+def list_values(column):
+    # note: values of all the lists of a list column, chunk by chunk (the pinned pyarrow has no list_flatten)
+    if column.num_chunks == 0:
+        return np.zeros(0, dtype=column.type.value_type.to_pandas_dtype())
+    return np.concatenate([chunk.flatten().to_numpy(zero_copy_only=False) for chunk in column.chunks])
+
+
+def read_points(store_path, columns=None, id_range=None):
+    # note: one row per point with a route_id column, the same layout as the csv outputs
+    columns = POINT_COLUMNS if columns is None else columns
+    table = read_trajectories(
+        store_path,
+        ['geometry'] + [
+            column_name for column_name in columns
+            if column_name in ATTRIBUTE_TYPES or column_name in OPTIONAL_ATTRIBUTE_TYPES
+        ],
+        id_range
+    )
+    if table.num_rows == 0:
+        return pd.DataFrame(columns=['route_id'] + list(columns))
+    longitudes, latitudes, offsets = decode_linestrings(table.column('geometry'))
+    points_df = pd.DataFrame({
+        'route_id': np.repeat(table.column('id').to_numpy(), np.diff(offsets))
+    })
+    for column_name in columns:
+        if column_name == 'longitude':
+            points_df['longitude'] = longitudes
+        elif column_name == 'latitude':
+            points_df['latitude'] = latitudes
+        else:
+            points_df[column_name] = list_values(table.column(column_name))
+    return points_df
+
+
+class TrajectoryBatch:
+    # note: struct-of-arrays container of a set of trajectories. the points of all routes are stored back to
+    #  back in coordinate, time (epoch ms) and attribute arrays and offsets delimit the routes, so slicing a
+    #  range of routes only makes views of the arrays.
+    def __init__(self, route_ids, offsets, longitudes, latitudes, timestamps, attributes=None):
+        self.route_ids = np.asarray(route_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.attributes = {} if attributes is None else {
+            column_name: np.asarray(values) for column_name, values in attributes.items()
+        }
+
+    def __len__(self):
+        return len(self.route_ids)
+
+    @property
+    def num_points(self):
+        return int(self.offsets[-1])
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, key):
+        # note: an int or a slice of routes gives views, an array of positions or a boolean mask copies
+        if isinstance(key, (int, np.integer)):
+            key = key + len(self) if key < 0 else key
+            key = slice(key, key + 1)
+        if isinstance(key, slice) and key.step in (None, 1):
+            first, last, _ = key.indices(len(self))
+            last = max(first, last)
+            first_point, last_point = self.offsets[first], self.offsets[last]
+            return TrajectoryBatch(
+                self.route_ids[first:last],
+                self.offsets[first:last + 1] - first_point,
+                self.longitudes[first_point:last_point],
+                self.latitudes[first_point:last_point],
+                self.timestamps[first_point:last_point],
+                {
+                    column_name: values[first_point:last_point]
+                    for column_name, values in self.attributes.items()
+                }
+            )
+        positions = np.arange(len(self))[key]
+        lengths = self.lengths[positions]
+        points = np.repeat(self.offsets[positions] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return TrajectoryBatch(
+            self.route_ids[positions],
+            np.concatenate([[0], np.cumsum(lengths)]),
+            self.longitudes[points],
+            self.latitudes[points],
+            self.timestamps[points],
+            {column_name: values[points] for column_name, values in self.attributes.items()}
+        )
+
+    def select_ids(self, route_ids):
+        # note: routes whose id is in route_ids
+        return self[np.isin(self.route_ids, np.asarray(list(route_ids)))]
+
+    def routes(self):
+        # note: route id and first/last point position of every route
+        return zip(self.route_ids.tolist(), self.offsets[:-1].tolist(), self.offsets[1:].tolist())
+
+    @staticmethod
+    def from_points(points_df, offsets=None):
+        # note: points frame with a route_id column (e.g. a csv output), the points of a route keep their order.
+        #  a frame already sorted by route with its route offsets is not sorted again.
+        if offsets is None:
+            points_df = points_df.sort_values(by='route_id', kind='stable')
+            offsets = route_offsets(points_df.route_id.to_numpy())
+        return TrajectoryBatch(
+            points_df.route_id.to_numpy()[offsets[:-1]],
+            offsets,
+            points_df.longitude.to_numpy(),
+            points_df.latitude.to_numpy(),
+            to_epoch_ms(points_df.timestamp) if 'timestamp' in points_df else np.zeros(len(points_df), dtype=np.int64),
+            {
+                column_name: points_df[column_name].to_numpy() for column_name in points_df.columns
+                if column_name not in ('route_id', 'longitude', 'latitude', 'timestamp')
+            }
+        )
+
+    @staticmethod
+    def read(store_path, columns=None, id_range=None):
+        # note: reads the store straight into a batch, without a points frame
+        columns = [column_name for column_name in (POINT_COLUMNS if columns is None else columns)
+                   if column_name in ATTRIBUTE_TYPES or column_name in OPTIONAL_ATTRIBUTE_TYPES]
+        table = read_trajectories(store_path, ['geometry'] + columns, id_range)
+        if table.num_rows == 0:
+            return TrajectoryBatch.concat([])
+        longitudes, latitudes, offsets = decode_linestrings(table.column('geometry'))
+        values = {column_name: list_values(table.column(column_name)) for column_name in columns}
+        timestamps = values.pop('timestamp', np.zeros(len(longitudes), dtype=np.int64))
+        return TrajectoryBatch(table.column('id').to_numpy(), offsets, longitudes, latitudes, timestamps, values)
+
+    @staticmethod
+    def concat(batches):
+        batches = list(batches)
+        if not batches:
+            return TrajectoryBatch(
+                np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64),
+                np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64)
+            )
+        lengths = np.concatenate([batch.lengths for batch in batches])
+        return TrajectoryBatch(
+            np.concatenate([batch.route_ids for batch in batches]),
+            np.concatenate([[0], np.cumsum(lengths)]),
+            np.concatenate([batch.longitudes for batch in batches]),
+            np.concatenate([batch.latitudes for batch in batches]),
+            np.concatenate([batch.timestamps for batch in batches]),
+            {
+                column_name: np.concatenate([batch.attributes[column_name] for batch in batches])
+                for column_name in batches[0].attributes
+                if all(column_name in batch.attributes for batch in batches)
+            }
+        )
+
+    def to_points(self, columns=None):
+        # note: points frame in the csv output layout (route_id, longitude, latitude, altitude, timestamp, ...)
+        points = {
+            'route_id': np.repeat(self.route_ids, self.lengths),
+            'longitude': self.longitudes,
+            'latitude': self.latitudes,
+            'timestamp': self.timestamps
+        }
+        points.update(self.attributes)
+        columns = ['route_id'] + [
+            column_name for column_name in POINT_COLUMNS + list(self.attributes) if column_name in points
+        ] if columns is None else columns
+        return pd.DataFrame({column_name: points[column_name] for column_name in dict.fromkeys(columns)})
+
+    def write(self, store_path, routes_per_group=ROUTES_PER_GROUP, crs=None):
+        return write_trajectories(self.to_points(), store_path, routes_per_group, crs)
+
+    def share(self, dir_path=None):
+        # note: publishes the arrays once for other processes, only the returned path has to be sent to them.
+        #  attributes of python objects can not be memory-mapped and are not shared.
+        shared_path = tempfile.mkdtemp(prefix='trajectory-batch-', dir=SHARED_DIR if dir_path is None else dir_path)
+        for array_name in SHARED_ARRAYS:
+            np.save(os.path.join(shared_path, array_name + '.npy'), getattr(self, array_name))
+        for column_name, values in self.attributes.items():
+            if not values.dtype.hasobject:
+                np.save(os.path.join(shared_path, 'attribute-' + column_name + '.npy'), values)
+        return shared_path
+
+    @staticmethod
+    def attach(shared_path):
+        # note: read-only batch over the memory-mapped arrays of a shared batch, nothing is copied. the
+        #  pages are shared by all the processes attached to it.
+        arrays = {
+            array_name: np.load(os.path.join(shared_path, array_name + '.npy'), mmap_mode='r')
+            for array_name in SHARED_ARRAYS
+        }
+        attributes = {
+            file_name[len('attribute-'):-len('.npy')]: np.load(os.path.join(shared_path, file_name), mmap_mode='r')
+            for file_name in sorted(os.listdir(shared_path)) if file_name.startswith('attribute-')
+        }
+        return TrajectoryBatch(attributes=attributes, **arrays)
+
+
+def release_shared(shared_path):
+    # note: removes a shared batch, processes still attached to it keep their mapping until they drop it
+    shutil.rmtree(shared_path, ignore_errors=True)
+
+
+def store_to_shapefile(store_path, shape_path, id_range=None):
+    # note: fmm reads trajectories from shape files, only the id and the geometry are written
+    table = read_trajectories(store_path, ['geometry'], id_range)
+    traj_directory = os.path.dirname(shape_path)
+    if traj_directory and not os.path.exists(traj_directory):
+        os.makedirs(traj_directory)
+    # note: stores written before routes with less than 2 points were dropped can still hold them, they are
+    #  not valid LineStrings and are skipped
+    geometries = table.column('geometry').to_pylist()
+    valid = np.array([len(geometry) >= WKB_HEADER_SIZE + 32 for geometry in geometries], dtype=bool)
+    if not valid.all():
+        print(f'{int((~valid).sum())} routes with less than 2 points are skipped')
+    df = gp.GeoDataFrame(
+        {'id': table.column('id').to_numpy()[valid]},
+        geometry=gp.GeoSeries([wkb.loads(geometry) for geometry, is_valid in zip(geometries, valid) if is_valid])
+    )
+    df.to_file(shape_path, driver='ESRI Shapefile')
+    return shape_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the trajectory store to a shape file')
+    parser.add_argument('--store_path', type=str, help='Path to trajectory store directory')
+    parser.add_argument('--shape_output_path', type=str, help='Path to save trajectories shape file (.shp)')
+    parser.add_argument('--id_range', type=str, default='', help='Range of route ids to convert (first-last)')
+    args = parser.parse_args()
+
+    store_to_shapefile(args.store_path, args.shape_output_path, parse_id_range(args.id_range))